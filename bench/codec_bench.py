@@ -0,0 +1,76 @@
+"""Encode/decode throughput benchmark for the column codecs in src/codec.py.
+
+The data mimics the datamock fridge telemetry: 10 s timestamps with a few
+milliseconds of jitter, slowly drifting thermometer readings, and valve
+states that rarely change.
+
+Run with: python bench/codec_bench.py
+"""
+
+import array
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import codec  # pylint: disable=wrong-import-position
+
+N = 100_000
+
+
+def _columns():
+    rng = random.Random(0)
+    t = 1_700_000_000_000_000_000
+    times: list[int] = []
+    temps: list[float] = []
+    valves: list[bool] = []
+    temp = 0.012
+    valve = False
+    for _ in range(N):
+        t += 10_000_000_000 + rng.randint(0, 3_000_000)
+        times.append(t)
+        temp += rng.gauss(0, 1e-5)
+        temps.append(round(temp, 6))
+        if rng.random() < 0.001:
+            valve = not valve
+        valves.append(valve)
+    return {
+        "times (q)": (times, "q"),
+        "temperature (d)": (temps, "d"),
+        "valve.open (b)": (valves, "b"),
+    }
+
+
+def _bench(values: list[int] | list[float] | list[bool], typecode: str):
+    raw = len(array.array(typecode, values).tobytes())
+
+    start = time.perf_counter()
+    encoded = codec.encode(values, typecode)
+    encode_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = codec.decode(encoded, typecode)
+    decode_s = time.perf_counter() - start
+
+    assert decoded.tobytes() == array.array(typecode, values).tobytes()
+    return raw, len(encoded), encode_s, decode_s
+
+
+def main():
+    """Print size ratio and throughput for each column type."""
+    print(
+        f"{'column':<18}{'raw B':>10}{'enc B':>10}{'ratio':>8}"
+        + f"{'enc/s':>12}{'dec/s':>12}"
+    )
+    for name, (values, typecode) in _columns().items():
+        raw, encoded, encode_s, decode_s = _bench(values, typecode)
+        print(
+            f"{name:<18}{raw:>10}{encoded:>10}{raw / encoded:>8.1f}"
+            f"{N / encode_s:>12.0f}{N / decode_s:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Cold start benchmark for one-shot runs of src/main.py.
+
+Starts a stub influxdb server in this process, then runs
+`main.py --once` against it in fresh interpreters and reports:
+
+- the time to import `main`, and the modules a sync needs;
+- the time from spawning the process to its first flux query;
+- the time until the process exits.
+
+The stub answers pings, bucket lookups, queries and writes without any data,
+so the numbers measure centraldb's own startup cost.
+
+Run with: python bench/startup_bench.py
+"""
+
+import http.server
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+RUNS = 5
+
+_first_query: list[float] = []
+
+
+class _StubInflux(http.server.BaseHTTPRequestHandler):
+    def _reply(self, status: int, body: bytes = b"", content_type: str = ""):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answer pings and bucket lookups."""
+        if self.path.startswith("/ping"):
+            self._reply(204)
+        elif self.path.startswith("/api/v2/buckets"):
+            bucket = {"id": "1", "name": "bench", "orgID": "1", "retentionRules": []}
+            body = json.dumps({"buckets": [bucket]}).encode()
+            self._reply(200, body, "application/json")
+        else:
+            self._reply(404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Answer queries with an empty result, and accept writes."""
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/api/v2/query"):
+            if not _first_query:
+                _first_query.append(time.perf_counter())
+            self._reply(200, b"\r\n", "text/csv")
+        else:
+            self._reply(204)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def _python(code: str, env: dict[str, str]):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=SRC, env=env, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    """Run the benchmark and print the median of every measurement."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _StubInflux)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = os.path.join(tmp, "sources.yaml")
+        with open(config, "w", encoding="utf-8") as f:
+            f.write(
+                f"""sources:
+  - name: bench
+    url: {url}
+    token: token
+    org: org
+    bucket: bench
+    destinations:
+      - name: local
+        url: {url}
+        token: token
+        org: org
+"""
+            )
+
+        env = dict(os.environ, DBDIR=os.path.join(tmp, "db"))
+        env.pop("TRACKING_DB", None)
+
+        baseline = [_python("pass", env) for _ in range(RUNS)]
+        import_main = [_python("import main", env) for _ in range(RUNS)]
+        import_sync = [_python("import sync", env) for _ in range(RUNS)]
+
+        to_query: list[float] = []
+        to_exit: list[float] = []
+        for _ in range(RUNS):
+            _first_query.clear()
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "main.py", "--once", "--config", config],
+                cwd=SRC,
+                env=env,
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            to_exit.append(time.perf_counter() - start)
+            to_query.append(_first_query[0] - start)
+
+    server.shutdown()
+
+    for name, samples in (
+        ("interpreter start", baseline),
+        ("import main", import_main),
+        ("import sync", import_sync),
+        ("start to first query", to_query),
+        ("start to exit", to_exit),
+    ):
+        print(f"{name:<22}{statistics.median(samples) * 1000:>8.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+"""Module providing an asyncio runtime for the sync loop.
+
+The blocking client needs one OS thread per concurrent query or write. This
+runtime instead schedules the syncs of every source as tasks in a single
+event loop using `InfluxDBClientAsync`, with a semaphore bounding the number
+of syncs in flight. Long ranges are partitioned by `planner` as in the
+threaded runtime, and the partitions of a source are queried concurrently up
+to its `max-concurrent-queries`. Batches are written to every
+destination of a source concurrently. Influxdb writes are submitted to a
+queue per bucket, shared by every sync of the loop, whose task writes them
+with the async client, so the batches of many small syncs are written
+together as `coalescer` does for threads; archive destinations are written
+from a worker thread, since the archive uses blocking file io.
+
+The async client requires aiohttp, installed with `influxdb-client[async]`.
+"""
+
+import asyncio
+from collections.abc import AsyncIterator
+from typing import NamedTuple
+
+import influxdb_client
+import influxdb_client.client.flux_table
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+import breaker
+import catalog
+import coalescer
+import destinations
+import env
+import flux
+import governor
+import latest
+import memory
+
+
+class Job(NamedTuple):
+    """A single sync of a source.
+
+    The queries of its partitions are run `parallelism` at a time, or in
+    order if `parallelism` is 1.
+    """
+
+    name: str
+    url: str
+    token: str
+    org: str
+    queries: list[str]
+    dests: list[destinations.Destination]
+    limits: governor.Limits
+    parallelism: int = 1
+
+
+class _Item(NamedTuple):
+    lines: list[str]
+    nbytes: int
+    future: asyncio.Future[None]
+
+
+class _BucketQueue:
+    """Task writing the lines queued for a single bucket from the event loop.
+
+    Submissions are coalesced like those of `coalescer`, but written with the
+    async client, so waiting on a write never holds a thread.
+    """
+
+    def __init__(self, client: InfluxDBClientAsync, bucket: str):
+        self.bucket = bucket
+        self.write_api = client.write_api()
+        self._changed = asyncio.Event()
+        self._items: list[_Item] = []
+        self._bytes = 0
+        self._oldest = 0.0
+        self._producers = 0
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+
+    def attach(self):
+        """Count one more writer submitting to the queue."""
+        self._producers += 1
+
+    def detach(self):
+        """Count one writer less, which no longer submits to the queue."""
+        self._producers -= 1
+        self._changed.set()
+
+    def submit(self, lines: list[str]):
+        """Queue lines to be written, returning a future of the write."""
+        if self._closed:
+            raise RuntimeError(f"Writer of bucket '{self.bucket}' is closed")
+        loop = asyncio.get_running_loop()
+        item = _Item(lines, sum(len(line) + 1 for line in lines), loop.create_future())
+        if not self._items:
+            self._oldest = loop.time()
+        self._items.append(item)
+        self._bytes += item.nbytes
+        self._changed.set()
+        return item.future
+
+    async def _take(self):
+        """Wait until the queue should be written, and take the items to write."""
+        loop = asyncio.get_running_loop()
+        while True:
+            self._changed.clear()
+            if self._items:
+                waited = loop.time() - self._oldest
+                # Every attached writer has submitted, so no one else is going
+                # to join this write.
+                if (
+                    self._bytes >= coalescer.TARGET_BYTES
+                    or self._closed
+                    or waited >= coalescer.LINGER
+                    or len(self._items) >= max(1, self._producers)
+                ):
+                    break
+                try:
+                    await asyncio.wait_for(
+                        self._changed.wait(), coalescer.LINGER - waited
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            elif self._closed:
+                return []
+            else:
+                await self._changed.wait()
+
+        items: list[_Item] = []
+        nbytes = 0
+        while self._items and (not items or nbytes < coalescer.TARGET_BYTES):
+            item = self._items.pop(0)
+            items.append(item)
+            nbytes += item.nbytes
+        self._bytes -= nbytes
+        self._oldest = loop.time()
+        return items
+
+    async def _run(self):
+        while items := await self._take():
+            lines = [line for item in items for line in item.lines]
+            error: Exception | None = None
+            for _ in range(5):
+                try:
+                    await self.write_api.write(bucket=self.bucket, record=lines)
+                    break
+                except Exception:  # pylint: disable=broad-exception-caught
+                    await asyncio.sleep(1)
+            else:
+                error = IOError(f"Failed to write points to '{self.bucket}'")
+
+            for item in items:
+                # The submitting task may have been cancelled.
+                if item.future.done():
+                    continue
+                if error is None:
+                    item.future.set_result(None)
+                else:
+                    item.future.set_exception(error)
+
+    async def close(self):
+        """Write any queued lines and stop the task."""
+        self._closed = True
+        self._changed.set()
+        await self._task
+
+
+class _Writes:
+    """The bucket queues and async clients shared by the syncs of `sync_all`."""
+
+    def __init__(self):
+        self._clients: dict[tuple[str, str, str], InfluxDBClientAsync] = {}
+        self._queues: dict[tuple[tuple[str, str, str], str], _BucketQueue] = {}
+
+    def queue(self, target: destinations.InfluxDestination):
+        """Return the queue of the bucket of a target, starting it if needed."""
+        server = (target.url, target.token, target.org)
+        bucket: str = target.bucket  # type: ignore
+        q = self._queues.get((server, bucket))
+        if q is None:
+            client = self._clients.get(server)
+            if client is None:
+                client = InfluxDBClientAsync(
+                    url=target.url, token=target.token, org=target.org
+                )
+                self._clients[server] = client
+            q = _BucketQueue(client, bucket)
+            self._queues[(server, bucket)] = q
+        return q
+
+    async def close(self):
+        """Write everything queued, then close every queue and client."""
+        await asyncio.gather(*(q.close() for q in self._queues.values()))
+        await asyncio.gather(*(c.close() for c in self._clients.values()))
+
+
+class _AsyncWriter:
+    """Writes batches to a single destination from the event loop."""
+
+    def __init__(
+        self, dest: destinations.Destination, source_name: str, writes: _Writes
+    ):
+        self.dest = dest
+        self.source_name = source_name
+        self.writes = writes
+        self.targets: list[destinations.InfluxDestination] = []
+
+    async def open(self):
+        """Connect to the destination, creating its buckets if needed."""
+        dest = self.dest
+        if isinstance(dest, destinations.ArchiveDestination):
+            return
+
+        # Routing is a tracking database lookup and the bucket check is cached,
+        # so this only briefly blocks a worker thread.
+        def resolve():
+            targets = destinations.influx_targets(dest, self.source_name)
+            for target in targets:
+                client = coalescer.client(target.url, target.token, target.org)
+                bucket: str = target.bucket  # type: ignore
+                if not destinations.ensure_bucket_exists(bucket, client):
+                    raise IOError(f"Could not find or create bucket '{target.bucket}'")
+            return targets
+
+        self.targets = await asyncio.to_thread(resolve)
+        for target in self.targets:
+            self.writes.queue(target).attach()
+
+    async def write(self, batch: destinations.Batch):
+        """Write a batch to the destination."""
+        dest = self.dest
+        if isinstance(dest, destinations.ArchiveDestination):
+            import archive  # pylint: disable=import-outside-toplevel
+
+            await asyncio.to_thread(
+                archive.append_records, dest.path, self.source_name, batch.records
+            )
+            return
+
+        # Batches of every task writing to the same bucket are coalesced.
+        await asyncio.gather(
+            *(self.writes.queue(t).submit(batch.lines) for t in self.targets)
+        )
+
+    async def close(self):
+        """Release any resources held by the writer."""
+        for target in self.targets:
+            self.writes.queue(target).detach()
+        self.targets = []
+
+
+async def _batches(
+    records: AsyncIterator[influxdb_client.client.flux_table.FluxRecord],
+    gov: governor.Governor,
+):
+    """Read records in batches sized by the memory budget, pacing the reads."""
+    batch: list[influxdb_client.client.flux_table.FluxRecord] = []
+    lines: list[str] = []
+    batch_bytes = 0
+    pending_bytes = 0
+
+    async for record in records:
+        batch.append(record)
+        line = flux.record_to_point(record).to_line_protocol()
+        if line:
+            lines.append(line)
+            pending_bytes += len(line) + 1
+        batch_bytes += memory.estimate_record(line)
+
+        if len(batch) % 1000 == 0:
+            await asyncio.sleep(gov.reserve(pending_bytes))
+            pending_bytes = 0
+
+        if batch_bytes >= memory.BUDGET.batch_bytes:
+            await asyncio.sleep(gov.reserve(pending_bytes))
+            pending_bytes = 0
+            yield destinations.Batch(batch, lines, batch_bytes)
+            batch, lines, batch_bytes = [], [], 0
+
+    await asyncio.sleep(gov.reserve(pending_bytes))
+    if batch:
+        yield destinations.Batch(batch, lines, batch_bytes)
+
+
+class _Budget:
+    """Takes and releases the memory budget from the event loop.
+
+    In the async runtime only the event loop takes the budget, so a task
+    waiting for it is woken by the releases made here instead of polling.
+    """
+
+    def __init__(self):
+        self._released = asyncio.Condition()
+
+    async def acquire(self, nbytes: int):
+        """Take `nbytes` of the budget without blocking the event loop."""
+        async with self._released:
+            while (taken := memory.BUDGET.acquire(nbytes, timeout=0)) is None:
+                await self._released.wait()
+        return taken
+
+    async def release(self, nbytes: int):
+        """Return bytes taken by `acquire`, waking the tasks waiting for them."""
+        memory.BUDGET.release(nbytes)
+        async with self._released:
+            self._released.notify_all()
+
+
+async def _sync(job: Job, writes: _Writes, budget: _Budget):
+    """Sync a single source to all of its destinations.
+
+    Returns:
+        (dict[str, Exception | None]): For every destination, None if it was
+        fully synced, otherwise the reason it failed.
+    """
+    gov = governor.for_source(job.name, job.limits)
+    results: dict[str, Exception | None] = {dest.name: None for dest in job.dests}
+    writers: dict[str, _AsyncWriter] = {}
+
+    async def open_writer(dest: destinations.Destination):
+        writer = _AsyncWriter(dest, job.name, writes)
+        try:
+            await writer.open()
+            writers[dest.name] = writer
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            results[dest.name] = e
+
+    await asyncio.gather(*(open_writer(dest) for dest in job.dests))
+
+    async def write(name: str, batch: destinations.Batch):
+        try:
+            await writers[name].write(batch)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            results[name] = e
+            await writers.pop(name).close()
+
+    async def sync_query(client: InfluxDBClientAsync, query: str):
+        if not writers:
+            return
+        records = await client.query_api().query_stream(query)
+        async for batch in _batches(records, gov):
+            if not writers:
+                break
+            latest.CACHE.update(job.name, batch)
+            catalog.CATALOG.update(job.name, batch)
+            taken = await budget.acquire(batch.nbytes)
+            try:
+                await asyncio.gather(*(write(name, batch) for name in list(writers)))
+            finally:
+                await budget.release(taken)
+
+    queries = asyncio.Semaphore(job.parallelism)
+
+    async def sync_partition(client: InfluxDBClientAsync, query: str):
+        async with queries:
+            await sync_query(client, query)
+
+    try:
+        async with InfluxDBClientAsync(
+            url=job.url, token=job.token, org=job.org
+        ) as client:
+            if job.parallelism == 1:
+                for query in job.queries:
+                    await sync_query(client, query)
+            else:
+                # Every partition is finished before the writers are closed.
+                errors = await asyncio.gather(
+                    *(sync_partition(client, query) for query in job.queries),
+                    return_exceptions=True,
+                )
+                for error in errors:
+                    if isinstance(error, BaseException):
+                        raise error
+    finally:
+        await asyncio.gather(*(writer.close() for writer in writers.values()))
+
+    return results
+
+
+async def _probe(job: Job):
+    async with InfluxDBClientAsync(
+        url=job.url, token=job.token, org=job.org, timeout=breaker.PROBE_TIMEOUT
+    ) as client:
+        return await client.ping()
+
+
+async def sync_all(jobs: list[Job], concurrency: int = env.ASYNC_CONCURRENCY):
+    """Run the syncs of every job concurrently in the current event loop.
+
+    Args:
+        jobs (list[Job]): The syncs to run.
+        concurrency (int): The maximum number of syncs in flight at once.
+
+    Returns:
+        (dict[str, dict[str, Exception | None] | Exception]): Per job name,
+        either the per destination results of the sync, or the error that
+        failed the whole sync.
+    """
+    overall = asyncio.Semaphore(concurrency)
+
+    async def run(job: Job):
+        async with overall:
+            source_breaker = breaker.for_source(job.name)
+            try:
+                if not await _probe(job):
+                    raise IOError(f"'{job.url}' did not answer ping")
+                result = await _sync(job, writes, budget)
+                source_breaker.success()
+                return result
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                source_breaker.failure(e)
+                return e
+
+    runnable = [job for job in jobs if breaker.for_source(job.name).allow()]
+    writes = _Writes()
+    budget = _Budget()
+    try:
+        results = await asyncio.gather(*(run(job) for job in runnable))
+    finally:
+        await writes.close()
+    return {job.name: result for job, result in zip(runnable, results)}
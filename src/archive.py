@@ -0,0 +1,588 @@
+"""Module providing a local, memory-mapped archive of synced data.
+
+The archive stores every numeric or boolean field of every series as a pair
+of append-only column files, partitioned by UTC day:
+
+    <root>/<source>/<measurement>/<tags>/<field>/<YYYYMMDD>.t
+    <root>/<source>/<measurement>/<tags>/<field>/<YYYYMMDD>.<typecode>
+
+The `.t` file holds the timestamps of the partition as native int64
+nanoseconds, in strictly increasing order, and the value file holds one value
+per timestamp using the `array` typecode in its suffix ("d", "q" or "b").
+
+Because timestamps are sorted, the timestamp column is its own time index: a
+range query memory-maps the partitions overlapping [start, stop), bisects the
+timestamp column for the bounds, and returns zero-copy memoryview slices of
+both columns.
+
+Partitions that are no longer written to can be compacted into a single
+`<YYYYMMDD>.z` file holding both columns encoded with `codec`. Compacted
+partitions are decoded in memory when read, and are expanded back into raw
+columns if late samples are appended to them.
+"""
+
+import argparse
+import array
+import bisect
+import calendar
+import collections
+import mmap
+import os
+import struct
+import time
+import urllib.parse
+from collections.abc import Iterable
+from typing import Any, NamedTuple
+
+import influxdb_client.client.flux_table
+
+import codec
+import flux
+
+_DAY_NS = 86400 * 1_000_000_000
+_TIME_SUFFIX = ".t"
+_PACKED_SUFFIX = ".z"
+# Typecode of the value column and length of the encoded timestamps.
+_PACKED_HEADER = struct.Struct(">cI")
+_VALUE_TYPECODES = ("d", "q", "b")
+
+Tags = tuple[tuple[str, str], ...]
+
+
+class Chunk(NamedTuple):
+    """A contiguous run of archived samples from a single partition.
+
+    Both members are memoryviews into the memory-mapped partition files.
+    """
+
+    times: memoryview
+    values: memoryview
+
+
+def _typecode(value: Any):
+    """Return the column typecode used to store `value`, or None if unsupported.
+
+    Integers outside the int64 range, such as large unsigned longs, are not
+    supported.
+    """
+    if isinstance(value, bool):
+        return "b"
+    if isinstance(value, int):
+        return "q" if -(2**63) <= value < 2**63 else None
+    if isinstance(value, float):
+        return "d"
+    return None
+
+
+def _tags_dirname(tags: Tags):
+    if not tags:
+        return "_"
+    return ",".join(
+        f"{urllib.parse.quote(k, safe='')}={urllib.parse.quote(v, safe='')}"
+        for k, v in tags
+    )
+
+
+def _series_dir(root: str, source: str, measurement: str, tags: Tags, field: str):
+    return os.path.join(
+        root,
+        urllib.parse.quote(source, safe=""),
+        urllib.parse.quote(measurement, safe=""),
+        _tags_dirname(tags),
+        urllib.parse.quote(field, safe=""),
+    )
+
+
+def _partition_name(t_ns: int):
+    return time.strftime("%Y%m%d", time.gmtime(t_ns // 1_000_000_000))
+
+
+def _find_value_file(partition_path: str):
+    """Return the (path, typecode) of a partition's value column, if it exists."""
+    for code in _VALUE_TYPECODES:
+        path = f"{partition_path}.{code}"
+        if os.path.exists(path):
+            return path, code
+    return None, None
+
+
+def _last_time(time_path: str):
+    """Return the last timestamp stored in a timestamp column, or None."""
+    try:
+        with open(time_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size < 8:
+                return None
+            f.seek(size - size % 8 - 8)
+            last = array.array("q")
+            last.frombytes(f.read(8))
+            return last[0]
+    except FileNotFoundError:
+        return None
+
+
+def _read_packed(packed_path: str):
+    """Return the decoded (times, values) columns of a compacted partition."""
+    with open(packed_path, "rb") as f:
+        data = f.read()
+    code, times_len = _PACKED_HEADER.unpack_from(data)
+    offset = _PACKED_HEADER.size
+    times = codec.decode_ints(memoryview(data)[offset : offset + times_len])
+    values = codec.decode(memoryview(data)[offset + times_len :], code.decode())
+    return times, values
+
+
+def _pack_partition(partition_path: str):
+    """Compact the raw columns of a partition into a single encoded file."""
+    value_path, code = _find_value_file(partition_path)
+    if value_path is None or code is None:
+        return False
+
+    time_path = partition_path + _TIME_SUFFIX
+    times = array.array("q")
+    values = array.array(code)
+    with open(time_path, "rb") as f:
+        times.frombytes(f.read())
+    with open(value_path, "rb") as f:
+        data = f.read()
+        values.frombytes(data[: len(data) - len(data) % values.itemsize])
+    count = min(len(times), len(values))
+
+    encoded_times = codec.encode_ints(times[:count])
+    encoded_values = codec.encode(values[:count], code)
+
+    packed_path = partition_path + _PACKED_SUFFIX
+    with open(packed_path + ".tmp", "wb") as f:
+        f.write(_PACKED_HEADER.pack(code.encode(), len(encoded_times)))
+        f.write(encoded_times)
+        f.write(encoded_values)
+
+    # The raw columns are only removed once the packed file decodes back to
+    # exactly the same bytes.
+    try:
+        packed_times, packed_values = _read_packed(packed_path + ".tmp")
+        valid = (
+            packed_times.tobytes() == times[:count].tobytes()
+            and packed_values.tobytes() == values[:count].tobytes()
+        )
+    except (ValueError, OverflowError, IndexError, struct.error):
+        valid = False
+    if not valid:
+        os.remove(packed_path + ".tmp")
+        print(f"FAILED TO COMPACT '{partition_path}': packed columns differ.")
+        return False
+
+    os.replace(packed_path + ".tmp", packed_path)
+    os.remove(time_path)
+    os.remove(value_path)
+    return True
+
+
+def _unpack_partition(partition_path: str):
+    """Expand a compacted partition back into raw columns."""
+    packed_path = partition_path + _PACKED_SUFFIX
+    times, values = _read_packed(packed_path)
+    with open(f"{partition_path}.{values.typecode}", "wb") as f:
+        values.tofile(f)
+    with open(partition_path + _TIME_SUFFIX, "wb") as f:
+        times.tofile(f)
+    os.remove(packed_path)
+
+
+def compact(root: str, before: float):
+    """Compact every raw partition that ends at or before `before`.
+
+    Args:
+        root (str): The root directory of the archive.
+        before (float): Cutoff in seconds since the epoch. Only partitions
+        whose day ended by this time are compacted.
+
+    Returns:
+        (int): The number of partitions compacted.
+    """
+    cutoff = _partition_name(int(before * 1_000_000_000) - _DAY_NS)
+    compacted = 0
+    for directory, _, files in os.walk(root):
+        for name in files:
+            partition, suffix = os.path.splitext(name)
+            if suffix == _TIME_SUFFIX and partition <= cutoff:
+                if _pack_partition(os.path.join(directory, partition)):
+                    compacted += 1
+    return compacted
+
+
+def _align_columns(time_path: str, value_path: str, typecode: str):
+    """Truncate both columns of a partition to the samples they both hold.
+
+    A crash between the two writes of an append leaves one column longer than
+    the other, which would misalign every later append.
+    """
+    columns = ((time_path, 8), (value_path, array.array(typecode).itemsize))
+    sizes: list[int] = []
+    for path, itemsize in columns:
+        try:
+            sizes.append(os.path.getsize(path) // itemsize)
+        except FileNotFoundError:
+            sizes.append(0)
+
+    count = min(sizes)
+    for path, itemsize in columns:
+        if os.path.exists(path) and os.path.getsize(path) != count * itemsize:
+            os.truncate(path, count * itemsize)
+
+
+def _append_partition(
+    partition_path: str, times: list[int], values: list[Any], typecode: str
+):
+    if os.path.exists(partition_path + _PACKED_SUFFIX):
+        _unpack_partition(partition_path)
+
+    value_path, existing_code = _find_value_file(partition_path)
+    if existing_code is not None and existing_code != typecode:
+        # The field changed type within the partition. Keep the partition
+        # homogeneous and drop the incompatible samples.
+        return 0
+    if value_path is None:
+        value_path = f"{partition_path}.{typecode}"
+
+    time_path = partition_path + _TIME_SUFFIX
+    _align_columns(time_path, value_path, typecode)
+    last = _last_time(time_path)
+
+    t_col = array.array("q")
+    v_col = array.array(typecode)
+    for t, v in zip(times, values):
+        # Syncs may overlap; only strictly newer samples are appended.
+        if last is None or t > last:
+            t_col.append(t)
+            v_col.append(v)
+            last = t
+
+    if not t_col:
+        return 0
+
+    # A crash between these writes leaves values without timestamps, which
+    # the next append truncates, see `_align_columns`.
+    with open(value_path, "ab") as f:
+        v_col.tofile(f)
+    with open(time_path, "ab") as f:
+        t_col.tofile(f)
+
+    return len(t_col)
+
+
+def append(
+    root: str,
+    source: str,
+    measurement: str,
+    tags: Tags,
+    field: str,
+    times: list[int],
+    values: list[Any],
+):
+    """Append samples of a single series to the archive.
+
+    Samples must be sorted by time. Samples at or before the last archived
+    timestamp of their partition are ignored, as are values that are not
+    numeric or boolean, and integers outside the int64 range.
+
+    Args:
+        root (str): The root directory of the archive.
+        source (str): The name of the source the series was synced from.
+        measurement (str): The measurement of the series.
+        tags (Tags): The sorted (key, value) tag pairs of the series.
+        field (str): The field of the series.
+        times (list[int]): Sample timestamps in nanoseconds since the epoch.
+        values (list[Any]): Sample values.
+
+    Returns:
+        (int): The number of samples appended.
+    """
+    directory = _series_dir(root, source, measurement, tags, field)
+
+    # Group samples into (partition, typecode) runs.
+    runs: dict[tuple[str, str], tuple[list[int], list[Any]]] = {}
+    out_of_range = 0
+    for t, v in zip(times, values):
+        code = _typecode(v)
+        if code is None:
+            if isinstance(v, int):
+                out_of_range += 1
+            continue
+        run = runs.setdefault((_partition_name(t), code), ([], []))
+        run[0].append(t)
+        run[1].append(v)
+
+    if out_of_range:
+        print(
+            f"Skipping {out_of_range} values of '{measurement}.{field}' outside the "
+            + "int64 range of the archive."
+        )
+
+    if not runs:
+        return 0
+
+    os.makedirs(directory, exist_ok=True)
+
+    appended = 0
+    for (partition, code), (run_times, run_values) in runs.items():
+        appended += _append_partition(
+            os.path.join(directory, partition), run_times, run_values, code
+        )
+
+    return appended
+
+
+def append_records(
+    root: str,
+    source: str,
+    records: Iterable[influxdb_client.client.flux_table.FluxRecord],
+):
+    """Append a batch of flux records to the archive.
+
+    Returns:
+        (int): The number of samples appended.
+    """
+    series: dict[tuple[str, Tags, str], tuple[list[int], list[Any]]] = (
+        collections.defaultdict(lambda: ([], []))
+    )
+
+    for record in records:
+        key = (record.get_measurement(), flux.record_tags(record), record.get_field())
+        samples = series[key]
+        samples[0].append(flux.time_ns(record.get_time()))
+        samples[1].append(record.get_value())
+
+    appended = 0
+    for (measurement, tags, field), (times, values) in series.items():
+        appended += append(root, source, measurement, tags, field, times, values)
+
+    return appended
+
+
+class Reader:
+    """Memory-mapped range reader for the archive.
+
+    Partition files are mapped lazily and kept open until the reader is closed.
+    Chunks returned by `query` reference the mapped files directly. They stay
+    valid after the reader is closed, and a file is unmapped once its last
+    chunk is garbage collected.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._maps: dict[str, mmap.mmap] = {}
+        self._packed: dict[str, tuple[array.array[int], array.array[Any]]] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_: object):
+        self.close()
+
+    def close(self):
+        """Unmap every partition file opened by this reader."""
+        for m in self._maps.values():
+            try:
+                m.close()
+            except BufferError:
+                # Chunks still reference the map, which is unmapped once they
+                # are garbage collected.
+                pass
+        self._maps.clear()
+        self._packed.clear()
+
+    def _map(self, path: str):
+        m = self._maps.get(path)
+        if m is None:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[path] = m
+        return m
+
+    def _columns(self, partition_path: str):
+        """Return memoryviews of the (times, values) columns of a partition."""
+        value_path, code = _find_value_file(partition_path)
+        if value_path is None or code is None:
+            packed_path = partition_path + _PACKED_SUFFIX
+            if packed_path not in self._packed:
+                if not os.path.exists(packed_path):
+                    return None
+                self._packed[packed_path] = _read_packed(packed_path)
+            times, values = self._packed[packed_path]
+            return memoryview(times), memoryview(values)
+
+        time_map = self._map(partition_path + _TIME_SUFFIX)
+        value_map = self._map(value_path)
+        if time_map is None or value_map is None:
+            return None
+
+        itemsize = array.array(code).itemsize
+        return (
+            memoryview(time_map)[: len(time_map) // 8 * 8].cast("q"),
+            memoryview(value_map)[: len(value_map) // itemsize * itemsize].cast(code),
+        )
+
+    def query(
+        self,
+        source: str,
+        measurement: str,
+        tags: Tags,
+        field: str,
+        start: float,
+        stop: float,
+    ):
+        """Return the archived samples of a series within [start, stop).
+
+        Args:
+            source (str): The name of the source the series was synced from.
+            measurement (str): The measurement of the series.
+            tags (Tags): The sorted (key, value) tag pairs of the series.
+            field (str): The field of the series.
+            start (float): Start of the range, in seconds since the epoch.
+            stop (float): End of the range (exclusive), in seconds since the epoch.
+
+        Returns:
+            (list[Chunk]): One chunk per overlapping partition, in time order.
+        """
+        start_ns = int(start * 1_000_000_000)
+        stop_ns = int(stop * 1_000_000_000)
+        directory = _series_dir(self.root, source, measurement, tags, field)
+
+        chunks: list[Chunk] = []
+        if stop_ns <= start_ns or not os.path.isdir(directory):
+            return chunks
+
+        day = start_ns - start_ns % _DAY_NS
+        while day < stop_ns:
+            partition_path = os.path.join(directory, _partition_name(day))
+            day += _DAY_NS
+
+            columns = self._columns(partition_path)
+            if columns is None:
+                continue
+            times, values = columns
+
+            # A writer may have been interrupted between the two columns.
+            count = min(len(times), len(values))
+
+            lo = bisect.bisect_left(times, start_ns, 0, count)
+            hi = bisect.bisect_left(times, stop_ns, lo, count)
+            if lo < hi:
+                chunks.append(Chunk(times[lo:hi], values[lo:hi]))
+
+        return chunks
+
+
+_AGGREGATES = ("mean", "min", "max", "sum", "count", "first", "last")
+
+
+def aggregate(chunks: Iterable[Chunk], window: float, fn: str = "mean"):
+    """Aggregate chunks into fixed, epoch aligned windows.
+
+    Args:
+        chunks (Iterable[Chunk]): Chunks returned by `Reader.query`.
+        window (float): The window size in seconds.
+        fn (str): One of "mean", "min", "max", "sum", "count", "first" or "last".
+
+    Returns:
+        (list[tuple[int, float]]): The (window start ns, value) of every
+        non-empty window.
+    """
+    if fn not in _AGGREGATES:
+        raise ValueError(f"Unsupported aggregate '{fn}'. Expected one of {_AGGREGATES}")
+
+    window_ns = int(window * 1_000_000_000)
+    if window_ns <= 0:
+        raise ValueError("Aggregation window must be positive.")
+
+    # Windows may span partitions, so partial results are merged per window
+    # as (start, count, sum, min, max, first, last).
+    states: list[list[Any]] = []
+    for chunk in chunks:
+        times = chunk.times
+        n = len(times)
+        i = 0
+        while i < n:
+            window_start = times[i] - times[i] % window_ns
+            j = bisect.bisect_left(times, window_start + window_ns, i, n)
+            with chunk.values[i:j] as view:
+                count = j - i
+                total = sum(view) if fn in ("mean", "sum") else 0
+                low = min(view) if fn == "min" else 0
+                high = max(view) if fn == "max" else 0
+                first = view[0]
+                last = view[-1]
+
+            if states and states[-1][0] == window_start:
+                state = states[-1]
+                state[1] += count
+                state[2] += total
+                state[3] = min(state[3], low)
+                state[4] = max(state[4], high)
+                state[6] = last
+            else:
+                states.append([window_start, count, total, low, high, first, last])
+            i = j
+
+    index = {"count": 1, "sum": 2, "min": 3, "max": 4, "first": 5, "last": 6}
+    if fn == "mean":
+        return [(s[0], s[2] / s[1]) for s in states]
+    return [(s[0], s[index[fn]]) for s in states]
+
+
+def _parse_time(value: str):
+    try:
+        return float(value)
+    except ValueError:
+        return float(calendar.timegm(time.strptime(value, "%Y-%m-%dT%H:%M:%SZ")))
+
+
+def _parse_tag(value: str):
+    key, sep, tag_value = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"Tag '{value}' must be of the form key=value")
+    return key, tag_value
+
+
+def _main():
+    """Query the archive from the command line and print the result as csv."""
+    # Imported here so that the archive reader can be used without env's defaults.
+    import env  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(description=_main.__doc__)
+    parser.add_argument("source")
+    parser.add_argument("measurement")
+    parser.add_argument("field")
+    parser.add_argument("--tag", action="append", type=_parse_tag, default=[])
+    parser.add_argument("--start", type=_parse_time, default=0.0)
+    parser.add_argument("--stop", type=_parse_time, default=time.time())
+    parser.add_argument("--window", type=float, default=None)
+    parser.add_argument("--fn", choices=_AGGREGATES, default="mean")
+    parser.add_argument("--root", default=env.ARCHIVEDIR)
+    args = parser.parse_args()
+
+    if args.root is None:
+        parser.error("No archive directory. Set ARCHIVEDIR or pass --root.")
+
+    tags: Tags = tuple(sorted(args.tag))
+    with Reader(args.root) as reader:
+        chunks = reader.query(
+            args.source, args.measurement, tags, args.field, args.start, args.stop
+        )
+        if args.window is not None:
+            rows = aggregate(chunks, args.window, args.fn)
+        else:
+            rows = [
+                (t, v) for chunk in chunks for t, v in zip(chunk.times, chunk.values)
+            ]
+
+    for t, v in rows:
+        print(f"{t},{v}")
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,101 @@
+"""Module providing circuit breakers for unreachable sources.
+
+Every source has a breaker counting its consecutive failures. Once a source
+has failed `FAILURE_THRESHOLD` times in a row the breaker opens, and the
+source is skipped without any network traffic until its backoff expires. The
+backoff doubles with every further failure, up to `MAX_BACKOFF` seconds.
+
+Before any full query, a source is probed with a cheap `/ping` request with a
+short timeout, so a source that went down since the last cycle only costs the
+probe.
+"""
+
+import threading
+import time
+
+import influxdb_client
+
+FAILURE_THRESHOLD = 3
+BASE_BACKOFF = 30.0
+MAX_BACKOFF = 3600.0
+
+# Timeout of health probes in milliseconds.
+PROBE_TIMEOUT = 2000
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class Breaker:
+    """Circuit breaker tracking the health of a single source."""
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.last_error: str | None = None
+
+    @property
+    def state(self):
+        """Return the state of the breaker: closed, open or half-open."""
+        if self.failures < FAILURE_THRESHOLD:
+            return CLOSED
+        if time.time() < self.open_until:
+            return OPEN
+        return HALF_OPEN
+
+    def allow(self):
+        """Return True if the source should be tried."""
+        return self.state != OPEN
+
+    def success(self):
+        """Record a successful sync, closing the breaker."""
+        self.failures = 0
+        self.open_until = 0.0
+        self.last_error = None
+
+    def failure(self, error: object):
+        """Record a failed probe or sync, opening the breaker if needed."""
+        self.failures += 1
+        self.last_error = str(error)
+        if self.failures >= FAILURE_THRESHOLD:
+            backoff = BASE_BACKOFF * 2 ** (self.failures - FAILURE_THRESHOLD)
+            self.open_until = time.time() + min(backoff, MAX_BACKOFF)
+
+
+_breakers: dict[str, Breaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def for_source(name: str):
+    """Return the breaker of a source."""
+    with _breakers_lock:
+        return _breakers.setdefault(name, Breaker())
+
+
+def probe(url: str, token: str, org: str):
+    """Return True if the influxdb at `url` answers a ping."""
+    with influxdb_client.InfluxDBClient(
+        url=url, token=token, org=org, timeout=PROBE_TIMEOUT
+    ) as client:
+        return client.ping()
+
+
+def report():
+    """Return a line describing the state of every breaker that is not closed."""
+    with _breakers_lock:
+        unhealthy = {
+            name: b for name, b in _breakers.items() if b.state != CLOSED
+        }
+
+    if not unhealthy:
+        return "All sources healthy."
+
+    parts: list[str] = []
+    for name, b in sorted(unhealthy.items()):
+        retry = max(0.0, b.open_until - time.time())
+        parts.append(
+            f"'{name}' {b.state} after {b.failures} failures "
+            + f"(retry in {retry:.0f}s, last error: {b.last_error})"
+        )
+    return "Unhealthy sources: " + "; ".join(parts)
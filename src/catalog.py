@@ -0,0 +1,373 @@
+"""Module maintaining a catalog of the schema of every source.
+
+Every batch a sync reads passes through `observe`, which records the series
+(measurement and tags) and fields it holds, the type of every field, and the
+first and last time each series and field was seen. The catalog is kept in
+memory, and what changed is written to the tracking database whenever the
+sync state of a source is updated, so it survives restarts and is shared by
+every worker.
+
+Lookups are answered from memory, without querying the source:
+
+    catalog.CATALOG.measurements("mxp")
+    catalog.CATALOG.tag_values("mxp", "sensor", measurement="thermometer")
+
+A source is loaded from the tracking database on its first lookup, and
+reloaded after `_RELOAD_AFTER` seconds unless it has unsaved observations, so
+sources synced by other workers stay current. The catalog is also served as
+json next to the latest values, see `latest`.
+"""
+
+import json
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+import influxdb_client.client.flux_table
+
+import db
+import destinations
+import flux
+
+# Seconds after which a source without unsaved observations is reloaded.
+_RELOAD_AFTER = 60.0
+
+# (measurement, tags, field, first time, last time, value) of a series seen in
+# a batch, with times in nanoseconds.
+_Observation = tuple[str, flux.Tags, str, int, int, Any]
+
+
+def _field_type(value: Any):
+    """Return the influxdb type of a field value."""
+    # bool is a subclass of int.
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "float"
+    return "string"
+
+
+def _observe_records(
+    records: list[influxdb_client.client.flux_table.FluxRecord],
+) -> Iterator[_Observation]:
+    """Yield the observation of every series in a batch of records.
+
+    Every flux table holds a single series in time order, so only the first
+    and last record of each table are converted.
+    """
+    first: dict[int, influxdb_client.client.flux_table.FluxRecord] = {}
+    last: dict[int, influxdb_client.client.flux_table.FluxRecord] = {}
+    for r in records:
+        first.setdefault(r.table, r)
+        last[r.table] = r
+
+    for table, r in last.items():
+        value = r.get_value()
+        if value is None:
+            value = first[table].get_value()
+            if value is None:
+                continue
+        yield (
+            r.get_measurement(),
+            flux.record_tags(r),
+            r.get_field(),
+            flux.time_ns(first[table].get_time()),
+            flux.time_ns(r.get_time()),
+            value,
+        )
+
+
+def _observe_lines(texts: Iterable[str]) -> Iterator[_Observation]:
+    """Yield the observation of every series in line protocol texts.
+
+    Only the first and last line of each series key are parsed.
+    """
+    spans: dict[str, list[str]] = {}
+    for text in texts:
+        for line in text.split("\n"):
+            if not line:
+                continue
+            key = flux.series_key(line)
+            span = spans.get(key)
+            if span is None:
+                spans[key] = [line, line]
+            else:
+                span[1] = line
+
+    for first_line, last_line in spans.values():
+        t = flux.parse_line(first_line)[3]
+        measurement, tags, field, last_t, value = flux.parse_line(last_line)
+        yield measurement, tags, field, min(t, last_t), max(t, last_t), value
+
+
+class _Schema:
+    """The recorded schema of a single source."""
+
+    def __init__(self):
+        # measurement -> tags -> [first time, last time]
+        self.series: dict[str, dict[flux.Tags, list[float]]] = {}
+        # measurement -> field -> [type, first time, last time]
+        self.fields: dict[str, dict[str, list[Any]]] = {}
+        self.dirty_series: set[tuple[str, flux.Tags]] = set()
+        self.dirty_fields: set[tuple[str, str]] = set()
+        self.loaded = time.monotonic()
+
+    def put_series(self, measurement: str, tags: flux.Tags, first: float, last: float):
+        """Widen a series to a time range, returning whether it changed."""
+        span = self.series.setdefault(measurement, {}).get(tags)
+        if span is None:
+            self.series[measurement][tags] = [first, last]
+            return True
+        if first < span[0] or last > span[1]:
+            span[0] = min(span[0], first)
+            span[1] = max(span[1], last)
+            return True
+        return False
+
+    def put_field(
+        self, measurement: str, field: str, field_type: str, first: float, last: float
+    ):
+        """Widen and retype a field, returning whether it changed."""
+        entry = self.fields.setdefault(measurement, {}).get(field)
+        if entry is None:
+            self.fields[measurement][field] = [field_type, first, last]
+            return True
+        if entry[0] != field_type or first < entry[1] or last > entry[2]:
+            entry[0] = field_type
+            entry[1] = min(entry[1], first)
+            entry[2] = max(entry[2], last)
+            return True
+        return False
+
+
+class Catalog:
+    """The schema of every source, backed by the tracking database."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schemas: dict[str, _Schema] = {}
+
+    def _load(self, source: str):
+        schema = _Schema()
+        series, fields = db.get_catalog(source)
+        for measurement, tags, first, last in series:
+            schema.put_series(
+                measurement, tuple(sorted(json.loads(tags).items())), first, last
+            )
+        for measurement, field, field_type, first, last in fields:
+            schema.put_field(measurement, field, field_type, first, last)
+        return schema
+
+    def _stale(self, schema: _Schema | None):
+        return schema is None or (
+            not schema.dirty_series
+            and not schema.dirty_fields
+            and time.monotonic() - schema.loaded > _RELOAD_AFTER
+        )
+
+    def _schema(self, source: str):
+        """Return the schema of a source, loading it if needed.
+
+        Called and returns with the lock held, but releases it while loading,
+        so lookups of other sources are not blocked by the tracking database.
+        """
+        if not self._stale(self._schemas.get(source)):
+            return self._schemas[source]
+
+        self._lock.release()
+        try:
+            loaded = self._load(source)
+        finally:
+            self._lock.acquire()
+
+        # Another thread may have loaded or updated the source meanwhile.
+        schema = self._schemas.get(source)
+        if self._stale(schema):
+            schema = loaded
+            self._schemas[source] = schema
+        return schema
+
+    def update(self, source: str, batch: destinations.Batch):
+        """Record the series and fields of a batch read from `source`."""
+        if batch.records:
+            observations = list(_observe_records(batch.records))
+        else:
+            observations = list(_observe_lines(batch.lines))
+
+        with self._lock:
+            schema = self._schema(source)
+            for measurement, tags, field, first, last, value in observations:
+                first_s, last_s = first / 1e9, last / 1e9
+                if schema.put_series(measurement, tags, first_s, last_s):
+                    schema.dirty_series.add((measurement, tags))
+                if schema.put_field(
+                    measurement, field, _field_type(value), first_s, last_s
+                ):
+                    schema.dirty_fields.add((measurement, field))
+
+    def flush(self, source: str):
+        """Write what changed in the schema of a source to the tracking database."""
+        with self._lock:
+            schema = self._schemas.get(source)
+            if schema is None or not (schema.dirty_series or schema.dirty_fields):
+                return
+            dirty_series, schema.dirty_series = schema.dirty_series, set()
+            dirty_fields, schema.dirty_fields = schema.dirty_fields, set()
+            series = [
+                (m, json.dumps(dict(tags)), *schema.series[m][tags])
+                for m, tags in dirty_series
+            ]
+            fields = [(m, f, *schema.fields[m][f]) for m, f in dirty_fields]
+
+        try:
+            db.update_catalog(source, series, fields)
+        except BaseException:
+            # Keep the changes, to write them with the next flush.
+            with self._lock:
+                schema.dirty_series |= dirty_series
+                schema.dirty_fields |= dirty_fields
+            raise
+
+    def measurements(self, source: str):
+        """Return the names of the measurements of a source."""
+        with self._lock:
+            return sorted(self._schema(source).series)
+
+    def series(
+        self,
+        source: str,
+        measurement: str | None = None,
+        tags: dict[str, str] | None = None,
+    ):
+        """Return the series of a source matching the arguments.
+
+        Returns:
+            (list[dict[str, Any]]): One dict per series, with its measurement,
+            tags, and first and last time.
+        """
+        with self._lock:
+            schema = self._schema(source)
+            selected = (
+                schema.series.items()
+                if measurement is None
+                else [(measurement, schema.series.get(measurement, {}))]
+            )
+            result: list[dict[str, Any]] = []
+            for measurement_name, series in selected:
+                for series_tags, (first, last) in series.items():
+                    if tags and any(
+                        dict(series_tags).get(k) != v for k, v in tags.items()
+                    ):
+                        continue
+                    result.append(
+                        {
+                            "measurement": measurement_name,
+                            "tags": dict(series_tags),
+                            "first": first,
+                            "last": last,
+                        }
+                    )
+            return result
+
+    def cardinality(self, source: str, measurement: str | None = None):
+        """Return the number of series of a source, or of one of its measurements."""
+        with self._lock:
+            schema = self._schema(source)
+            if measurement is not None:
+                return len(schema.series.get(measurement, {}))
+            return sum(len(series) for series in schema.series.values())
+
+    def tag_keys(self, source: str, measurement: str | None = None):
+        """Return the tag keys of a source, or of one of its measurements."""
+        return sorted(
+            {key for s in self.series(source, measurement) for key in s["tags"]}
+        )
+
+    def tag_values(self, source: str, key: str, measurement: str | None = None):
+        """Return the values of a tag key in a source, or one of its measurements."""
+        return sorted(
+            {
+                s["tags"][key]
+                for s in self.series(source, measurement)
+                if key in s["tags"]
+            }
+        )
+
+    def fields(self, source: str, measurement: str | None = None):
+        """Return the fields of a source, or of one of its measurements.
+
+        Returns:
+            (list[dict[str, Any]]): One dict per field, with its measurement,
+            name, type, and first and last time.
+        """
+        with self._lock:
+            schema = self._schema(source)
+            selected = (
+                schema.fields.items()
+                if measurement is None
+                else [(measurement, schema.fields.get(measurement, {}))]
+            )
+            return [
+                {
+                    "measurement": measurement_name,
+                    "field": field,
+                    "type": field_type,
+                    "first": first,
+                    "last": last,
+                }
+                for measurement_name, fields in selected
+                for field, (field_type, first, last) in fields.items()
+            ]
+
+    def describe(self, source: str, measurement: str | None = None):
+        """Return the schema of a source, or one of its measurements, as json.
+
+        Returns:
+            (dict[str, Any]): Per measurement, its series count, first and last
+            time, tag keys with their values, and fields with their type and
+            first and last time.
+        """
+        result: dict[str, Any] = {}
+        for s in self.series(source, measurement):
+            entry = result.setdefault(
+                s["measurement"],
+                {
+                    "series": 0,
+                    "first": s["first"],
+                    "last": s["last"],
+                    "tags": {},
+                    "fields": {},
+                },
+            )
+            entry["series"] += 1
+            entry["first"] = min(entry["first"], s["first"])
+            entry["last"] = max(entry["last"], s["last"])
+            for key, value in s["tags"].items():
+                entry["tags"].setdefault(key, set()).add(value)
+
+        for entry in result.values():
+            entry["tags"] = {k: sorted(v) for k, v in sorted(entry["tags"].items())}
+
+        for f in self.fields(source, measurement):
+            if f["measurement"] in result:
+                result[f["measurement"]]["fields"][f["field"]] = {
+                    "type": f["type"],
+                    "first": f["first"],
+                    "last": f["last"],
+                }
+        return result
+
+
+CATALOG = Catalog()
+
+
+def observe(
+    source: str, batches: Iterable[destinations.Batch]
+) -> Iterator[destinations.Batch]:
+    """Record every batch read from `source` in the catalog as it passes through."""
+    for batch in batches:
+        CATALOG.update(source, batch)
+        yield batch
@@ -0,0 +1,215 @@
+"""Module providing a shared writer coalescing writes to influxdb buckets.
+
+Instead of every sync opening its own client and write api, and sending its
+batches as separate requests, writes are submitted to a single queue per
+destination bucket. A thread per queue combines everything submitted by any
+sync since its last write into one request. Writers writing to a bucket
+`attach` to its queue, and a write is sent as soon as every attached writer
+has submitted, since each of them waits for its previous write before
+submitting the next. Otherwise it is sent once `TARGET_BYTES` of line
+protocol are queued or the oldest submission has waited `LINGER` seconds, so
+a lone writer never waits.
+
+Every submission returns a future that completes once its lines have been
+written, or fails with the error of the write that included them. Clients are
+shared by every bucket of the same server, and are kept open between syncs.
+"""
+
+import concurrent.futures
+import threading
+import time
+from typing import NamedTuple
+
+import influxdb_client
+import influxdb_client.client.write_api
+
+# Line protocol bytes queued for a bucket before it is written immediately.
+TARGET_BYTES = 4 * 2**20
+
+# Seconds a submission may wait for other attached writers to coalesce with.
+LINGER = 0.2
+
+
+class _Server(NamedTuple):
+    url: str
+    token: str
+    org: str
+
+
+class _Item(NamedTuple):
+    lines: list[str]
+    nbytes: int
+    future: concurrent.futures.Future[None]
+
+
+class _BucketQueue(threading.Thread):
+    """Thread writing the lines queued for a single bucket."""
+
+    def __init__(self, client: influxdb_client.InfluxDBClient, bucket: str):
+        super().__init__(name=f"coalescer-{bucket}", daemon=True)
+        self.bucket = bucket
+        self.write_api = client.write_api(
+            write_options=influxdb_client.client.write_api.SYNCHRONOUS
+        )
+        self._cond = threading.Condition()
+        self._items: list[_Item] = []
+        self._bytes = 0
+        self._oldest = 0.0
+        self._producers = 0
+        self._closed = False
+
+    def attach(self):
+        """Count one more writer submitting to the queue."""
+        with self._cond:
+            self._producers += 1
+
+    def detach(self):
+        """Count one writer less, which no longer submits to the queue."""
+        with self._cond:
+            self._producers -= 1
+            self._cond.notify_all()
+
+    def submit(self, lines: list[str]):
+        """Queue lines to be written, returning a future of the write."""
+        item = _Item(
+            lines, sum(len(line) + 1 for line in lines), concurrent.futures.Future()
+        )
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"Writer of bucket '{self.bucket}' is closed")
+            if not self._items:
+                self._oldest = time.monotonic()
+            self._items.append(item)
+            self._bytes += item.nbytes
+            self._cond.notify_all()
+        return item.future
+
+    def _take(self):
+        """Wait until the queue should be written, and take the items to write."""
+        with self._cond:
+            while True:
+                if self._items:
+                    waited = time.monotonic() - self._oldest
+                    # Every attached writer has submitted, so no one else is
+                    # going to join this write.
+                    if (
+                        self._bytes >= TARGET_BYTES
+                        or self._closed
+                        or waited >= LINGER
+                        or len(self._items) >= max(1, self._producers)
+                    ):
+                        break
+                    self._cond.wait(LINGER - waited)
+                elif self._closed:
+                    return []
+                else:
+                    self._cond.wait()
+
+            items: list[_Item] = []
+            nbytes = 0
+            while self._items and (not items or nbytes < TARGET_BYTES):
+                item = self._items.pop(0)
+                items.append(item)
+                nbytes += item.nbytes
+            self._bytes -= nbytes
+            self._oldest = time.monotonic()
+            return items
+
+    def run(self):
+        while items := self._take():
+            lines = [line for item in items for line in item.lines]
+            error: Exception | None = None
+            for _ in range(5):
+                try:
+                    self.write_api.write(bucket=self.bucket, record=lines)
+                    break
+                except Exception:  # pylint: disable=broad-exception-caught
+                    time.sleep(1)
+            else:
+                error = IOError(f"Failed to write points to '{self.bucket}'")
+
+            for item in items:
+                if error is None:
+                    item.future.set_result(None)
+                else:
+                    item.future.set_exception(error)
+
+        self.write_api.close()
+
+    def close(self):
+        """Write any queued lines and stop the thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+_clients: dict[_Server, influxdb_client.InfluxDBClient] = {}
+_queues: dict[tuple[_Server, str], _BucketQueue] = {}
+_lock = threading.Lock()
+
+
+def client(url: str, token: str, org: str):
+    """Return the shared client of an influxdb server."""
+    server = _Server(url, token, org)
+    with _lock:
+        c = _clients.get(server)
+        if c is None:
+            c = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
+            _clients[server] = c
+        return c
+
+
+def _queue(url: str, token: str, org: str, bucket: str):
+    """Return the queue of a bucket, starting it if needed."""
+    key = (_Server(url, token, org), bucket)
+    shared = client(url, token, org)
+    with _lock:
+        q = _queues.get(key)
+        if q is None:
+            q = _BucketQueue(shared, bucket)
+            q.start()
+            _queues[key] = q
+        return q
+
+
+def attach(url: str, token: str, org: str, bucket: str):
+    """Register a writer that will submit to a bucket until it calls `detach`.
+
+    Submissions to a bucket are written without waiting for others once every
+    attached writer has submitted.
+    """
+    _queue(url, token, org, bucket).attach()
+
+
+def detach(url: str, token: str, org: str, bucket: str):
+    """Unregister a writer registered with `attach`."""
+    with _lock:
+        q = _queues.get((_Server(url, token, org), bucket))
+    if q is not None:
+        q.detach()
+
+
+def submit(url: str, token: str, org: str, bucket: str, lines: list[str]):
+    """Queue line protocol to be written to a bucket.
+
+    Returns:
+        (Future[None]): Completes once the lines are written, or fails with
+        the reason they could not be.
+    """
+    return _queue(url, token, org, bucket).submit(lines)
+
+
+def close():
+    """Write everything queued, then close every queue and client."""
+    with _lock:
+        queues = list(_queues.values())
+        clients = list(_clients.values())
+        _queues.clear()
+        _clients.clear()
+
+    for q in queues:
+        q.close()
+    for q in queues:
+        q.join()
+    for c in clients:
+        c.close()
@@ -0,0 +1,322 @@
+"""Module providing compact encodings for time series columns.
+
+The encodings follow the Gorilla paper (Pelkonen et al., VLDB 2015):
+
+  - Timestamps and integers are delta-of-delta encoded. Regularly sampled
+    timestamps cost a single bit each.
+  - Floats are XOR encoded against the previous value. Repeated or slowly
+    changing values cost between one bit and a handful of bits each.
+  - Booleans are run-length encoded, or packed into a bitmap when that is
+    smaller.
+
+Every encoded buffer starts with the number of encoded values as a big-endian
+uint32, so buffers can be decoded without any outside information.
+"""
+
+import array
+import struct
+from collections.abc import Sequence
+
+_COUNT = struct.Struct(">I")
+
+# Value bits of the delta-of-delta buckets. Bucket k is selected by a prefix of
+# k + 1 one bits followed by a zero bit, except for the last bucket which has
+# no terminating zero. Timestamps are stored in nanoseconds, so the buckets are
+# wider than in the paper: jitter of a few milliseconds fits in 24 bits.
+_DOD_VALUE_BITS = (7, 12, 24, 40, 64)
+_DOD_BUCKETS = tuple(
+    (((1 << (k + 1)) - 1) << 1, k + 2, bits)
+    for k, bits in enumerate(_DOD_VALUE_BITS[:-1])
+) + ((0b11111, 5, 64),)
+
+_BOOL_RLE = 0
+_BOOL_BITMAP = 1
+
+
+class _BitWriter:
+    """Big-endian bit stream writer."""
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._acc = 0
+        self._bits = 0
+
+    def write(self, value: int, nbits: int):
+        """Append the low `nbits` bits of `value` to the stream."""
+        self._acc = (self._acc << nbits) | (value & ((1 << nbits) - 1))
+        self._bits += nbits
+        if self._bits >= 64:
+            rem = self._bits & 7
+            self._buf += (self._acc >> rem).to_bytes(self._bits >> 3, "big")
+            self._acc &= (1 << rem) - 1
+            self._bits = rem
+
+    def getvalue(self):
+        """Return the stream, padded with zero bits to a whole byte."""
+        buf = bytearray(self._buf)
+        if self._bits:
+            pad = -self._bits & 7
+            buf += (self._acc << pad).to_bytes((self._bits + pad) >> 3, "big")
+        return bytes(buf)
+
+
+class _BitReader:
+    """Big-endian bit stream reader."""
+
+    def __init__(self, data: bytes | memoryview, offset: int = 0):
+        # Pad so that reads near the end never run off the buffer.
+        self._data = bytes(data[offset:]) + bytes(9)
+        self._pos = 0
+
+    def read(self, nbits: int):
+        """Read `nbits` bits (at most 64) as an unsigned integer."""
+        start = self._pos >> 3
+        window = int.from_bytes(self._data[start : start + 9], "big")
+        shift = 72 - (self._pos & 7) - nbits
+        self._pos += nbits
+        return (window >> shift) & ((1 << nbits) - 1)
+
+    def read_bit(self):
+        """Read a single bit."""
+        pos = self._pos
+        self._pos += 1
+        return (self._data[pos >> 3] >> (7 - (pos & 7))) & 1
+
+
+def _signed(value: int, nbits: int):
+    if value >= 1 << (nbits - 1):
+        return value - (1 << nbits)
+    return value
+
+
+def _wrap(value: int):
+    """Wrap an integer to a signed 64-bit value, as int64 arithmetic would."""
+    return ((value + (1 << 63)) & ((1 << 64) - 1)) - (1 << 63)
+
+
+def encode_ints(values: Sequence[int]):
+    """Delta-of-delta encode a sequence of int64 values, such as timestamps.
+
+    Deltas and deltas of deltas wrap around like int64 arithmetic, so any
+    int64 values round-trip, even if their differences overflow.
+    """
+    writer = _BitWriter()
+    n = len(values)
+    if n:
+        writer.write(values[0], 64)
+    if n > 1:
+        delta = _wrap(values[1] - values[0])
+        writer.write(delta, 64)
+        for i in range(2, n):
+            new_delta = _wrap(values[i] - values[i - 1])
+            dod = _wrap(new_delta - delta)
+            delta = new_delta
+            if dod == 0:
+                writer.write(0, 1)
+                continue
+            for prefix, prefix_bits, value_bits in _DOD_BUCKETS:
+                limit = 1 << (value_bits - 1)
+                if -limit <= dod < limit:
+                    break
+            writer.write(prefix, prefix_bits)
+            writer.write(dod, value_bits)
+
+    return _COUNT.pack(n) + writer.getvalue()
+
+
+def decode_ints(data: bytes | memoryview):
+    """Decode a buffer produced by `encode_ints`.
+
+    Returns:
+        (array.array): The decoded values, with typecode "q".
+    """
+    (n,) = _COUNT.unpack_from(data)
+    out = array.array("q")
+    if not n:
+        return out
+
+    reader = _BitReader(data, _COUNT.size)
+    value = _signed(reader.read(64), 64)
+    out.append(value)
+    if n == 1:
+        return out
+
+    delta = _signed(reader.read(64), 64)
+    value = _wrap(value + delta)
+    out.append(value)
+
+    for _ in range(n - 2):
+        if reader.read_bit():
+            ones = 1
+            while ones < len(_DOD_VALUE_BITS) and reader.read_bit():
+                ones += 1
+            value_bits = _DOD_VALUE_BITS[ones - 1]
+            delta = _wrap(delta + _signed(reader.read(value_bits), value_bits))
+        value = _wrap(value + delta)
+        out.append(value)
+
+    return out
+
+
+def encode_floats(values: Sequence[float]):
+    """XOR encode a sequence of float64 values."""
+    n = len(values)
+    bits = array.array("Q", array.array("d", values).tobytes())
+    writer = _BitWriter()
+
+    if n:
+        writer.write(bits[0], 64)
+
+    prev = bits[0] if n else 0
+    prev_leading = 65
+    prev_trailing = 0
+    for i in range(1, n):
+        current = bits[i]
+        xor = current ^ prev
+        prev = current
+        if not xor:
+            writer.write(0, 1)
+            continue
+
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if leading >= prev_leading and trailing >= prev_trailing:
+            # The meaningful bits fit in the previous window.
+            writer.write(0b10, 2)
+            writer.write(xor >> prev_trailing, 64 - prev_leading - prev_trailing)
+        else:
+            length = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            # A length of 64 does not fit in 6 bits, and is stored as 0.
+            writer.write(length & 63, 6)
+            writer.write(xor >> trailing, length)
+            prev_leading = leading
+            prev_trailing = trailing
+
+    return _COUNT.pack(n) + writer.getvalue()
+
+
+def decode_floats(data: bytes | memoryview):
+    """Decode a buffer produced by `encode_floats`.
+
+    Returns:
+        (array.array): The decoded values, with typecode "d".
+    """
+    (n,) = _COUNT.unpack_from(data)
+    bits = array.array("Q")
+    if n:
+        reader = _BitReader(data, _COUNT.size)
+        value = reader.read(64)
+        bits.append(value)
+        leading = 0
+        trailing = 0
+        for _ in range(n - 1):
+            if reader.read_bit():
+                if reader.read_bit():
+                    leading = reader.read(5)
+                    length = reader.read(6) or 64
+                    trailing = 64 - leading - length
+                else:
+                    length = 64 - leading - trailing
+                value ^= reader.read(length) << trailing
+            bits.append(value)
+
+    return array.array("d", bits.tobytes())
+
+
+def _write_varint(buf: bytearray, value: int):
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def encode_bools(values: Sequence[bool | int]):
+    """Run-length encode a sequence of booleans, or bitmap encode them if smaller."""
+    n = len(values)
+    rle = bytearray([_BOOL_RLE, 1 if n and values[0] else 0])
+    i = 0
+    while i < n:
+        current = bool(values[i])
+        j = i + 1
+        while j < n and bool(values[j]) == current:
+            j += 1
+        _write_varint(rle, j - i)
+        i = j
+
+    if len(rle) > 1 + (n + 7) // 8:
+        bitmap = _BitWriter()
+        for v in values:
+            bitmap.write(1 if v else 0, 1)
+        return _COUNT.pack(n) + bytes([_BOOL_BITMAP]) + bitmap.getvalue()
+
+    return _COUNT.pack(n) + bytes(rle)
+
+
+def decode_bools(data: bytes | memoryview):
+    """Decode a buffer produced by `encode_bools`.
+
+    Returns:
+        (array.array): The decoded values as 0 or 1, with typecode "b".
+    """
+    (n,) = _COUNT.unpack_from(data)
+    out = array.array("b")
+    if not n:
+        return out
+
+    pos = _COUNT.size
+    if data[pos] == _BOOL_BITMAP:
+        reader = _BitReader(data, pos + 1)
+        for _ in range(n):
+            out.append(reader.read_bit())
+        return out
+
+    current = data[pos + 1]
+    pos += 2
+    while len(out) < n:
+        run = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            run |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        out.extend(array.array("b", [current]) * run)
+        current ^= 1
+
+    return out
+
+
+def encode(values: Sequence[int] | Sequence[float] | Sequence[bool], typecode: str):
+    """Encode a column with the codec matching its `array` typecode.
+
+    Args:
+        values: The values to encode.
+        typecode (str): "q" for integers or timestamps, "d" for floats, or
+        "b" for booleans.
+    """
+    match typecode:
+        case "q":
+            return encode_ints(values)  # type: ignore
+        case "d":
+            return encode_floats(values)  # type: ignore
+        case "b":
+            return encode_bools(values)  # type: ignore
+        case _:
+            raise ValueError(f"Unsupported typecode '{typecode}'")
+
+
+def decode(data: bytes | memoryview, typecode: str):
+    """Decode a column encoded by `encode` with the same typecode."""
+    match typecode:
+        case "q":
+            return decode_ints(data)
+        case "d":
+            return decode_floats(data)
+        case "b":
+            return decode_bools(data)
+        case _:
+            raise ValueError(f"Unsupported typecode '{typecode}'")
@@ -0,0 +1,254 @@
+"""Module providing multi-process conversion of raw flux responses.
+
+Parsing flux csv and building line protocol is pure python, so a single
+sync is limited to one core. In process mode the reader only splits the raw
+annotated csv response into chunks of whole rows, each carrying the
+annotations and header of its table, and a pool of worker processes converts
+chunks to line protocol. Results are yielded in the order the chunks were
+read, so the time order of every series is preserved.
+
+Process mode is enabled by setting the CONVERT_PROCESSES environment variable
+to the number of worker processes.
+"""
+
+import calendar
+import concurrent.futures
+import csv
+import io
+import math
+import multiprocessing
+from collections.abc import Iterable, Iterator
+
+import env
+import flux
+
+# Maximum number of chunks queued to or returned from the pool per worker.
+_INFLIGHT_PER_WORKER = 2
+
+_MEASUREMENT_ESCAPES = str.maketrans({",": "\\,", " ": "\\ ", "\n": "\\n"})
+_KEY_ESCAPES = str.maketrans({",": "\\,", "=": "\\=", " ": "\\ ", "\n": "\\n"})
+_STRING_ESCAPES = str.maketrans({'"': '\\"', "\\": "\\\\"})
+
+_pool: concurrent.futures.ProcessPoolExecutor | None = None
+
+
+def _pool_for(processes: int):
+    global _pool  # pylint: disable=global-statement
+    if _pool is None:
+        # Forking a process running the heartbeat, coalescer and http threads
+        # could copy a lock another thread holds, deadlocking the child.
+        _pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+    return _pool
+
+
+def split_chunks(stream: Iterable[bytes], chunk_bytes: int):
+    """Split a raw annotated csv response into independently parsable chunks.
+
+    Args:
+        stream (Iterable[bytes]): The raw response, in arbitrary pieces.
+        chunk_bytes (int): The target size of the rows in each chunk.
+
+    Yields:
+        (tuple[bytes, bytes, int]): The (header, rows, raw size) of each
+        chunk. The header holds the annotations and header row of the table
+        the rows belong to.
+    """
+    annotations: list[bytes] = []
+    header: bytes | None = None
+    rows: list[bytes] = []
+    size = 0
+    raw = 0
+    pending = b""
+    last_was_annotation = False
+
+    def lines():
+        nonlocal pending
+        for piece in stream:
+            pending += piece
+            start = 0
+            while (end := pending.find(b"\n", start)) != -1:
+                line = pending[start : end + 1]
+                # A quoted string may contain newlines; keep reading until the
+                # quotes of the row are balanced.
+                while line.count(b'"') % 2:
+                    nxt = pending.find(b"\n", end + 1)
+                    if nxt == -1:
+                        break
+                    end = nxt
+                    line = pending[start : end + 1]
+                if line.count(b'"') % 2:
+                    break
+                yield line
+                start = end + 1
+            pending = pending[start:]
+        if pending:
+            yield pending
+
+    for line in lines():
+        raw += len(line)
+        is_annotation = line.startswith(b"#")
+        is_blank = not line.strip()
+
+        if is_blank or (is_annotation and not last_was_annotation):
+            # End of a table block.
+            if rows and header is not None:
+                yield b"".join(annotations) + header, b"".join(rows), raw
+                rows, size, raw = [], 0, 0
+            header = None
+            if is_annotation:
+                annotations = []
+        last_was_annotation = is_annotation
+
+        if is_annotation:
+            annotations.append(line)
+        elif is_blank:
+            continue
+        elif header is None:
+            header = line
+        else:
+            rows.append(line)
+            size += len(line)
+            if size >= chunk_bytes:
+                yield b"".join(annotations) + header, b"".join(rows), raw
+                rows, size, raw = [], 0, 0
+
+    if rows and header is not None:
+        yield b"".join(annotations) + header, b"".join(rows), raw
+
+
+def _rfc3339_ns(value: str):
+    """Return an RFC3339 UTC timestamp as nanoseconds since the epoch."""
+    seconds = calendar.timegm(
+        (
+            int(value[0:4]),
+            int(value[5:7]),
+            int(value[8:10]),
+            int(value[11:13]),
+            int(value[14:16]),
+            int(value[17:19]),
+            0,
+            0,
+            0,
+        )
+    )
+    nanos = 0
+    if len(value) > 20 and value[19] == ".":
+        fraction = value[20:].rstrip("Z")
+        nanos = int(fraction[:9].ljust(9, "0"))
+    return seconds * 1_000_000_000 + nanos
+
+
+def _field_value(value: str, datatype: str):
+    """Return a csv value as a line protocol field value, or None to skip it."""
+    match datatype:
+        case "double":
+            number = float(value)
+            if math.isnan(number) or math.isinf(number):
+                return None
+            return value
+        case "long":
+            return value + "i"
+        case "unsignedLong":
+            return value + "u"
+        case "boolean":
+            return "true" if value == "true" else "false"
+        case _:
+            return '"' + value.translate(_STRING_ESCAPES) + '"'
+
+
+def convert_chunk(header: bytes, rows: bytes):
+    """Convert a chunk produced by `split_chunks` to line protocol.
+
+    Returns:
+        (str): The chunk as newline separated line protocol.
+    """
+    reader = csv.reader(io.StringIO((header + rows).decode()))
+    datatypes: list[str] = []
+    defaults: list[str] = []
+    names: list[str] = []
+    for row in reader:
+        if row and row[0] == "#datatype":
+            datatypes = row
+        elif row and row[0] == "#default":
+            defaults = row
+        elif row and not row[0].startswith("#"):
+            names = row
+            break
+
+    try:
+        i_time = names.index("_time")
+        i_value = names.index("_value")
+        i_field = names.index("_field")
+        i_measurement = names.index("_measurement")
+    except ValueError:
+        # Not a table of records, for example an error table.
+        return ""
+
+    value_type = datatypes[i_value] if i_value < len(datatypes) else "string"
+    tag_columns = sorted(
+        (name, i)
+        for i, name in enumerate(names)
+        if i > 0 and name and name not in flux.NON_TAG_COLUMNS
+    )
+    tag_keys = [(name.translate(_KEY_ESCAPES), i) for name, i in tag_columns]
+
+    out: list[str] = []
+    for row in reader:
+        if len(row) < len(names):
+            continue
+        if defaults:
+            row = [
+                v or (defaults[i] if i < len(defaults) else v)
+                for i, v in enumerate(row)
+            ]
+
+        value = row[i_value]
+        if value == "":
+            continue
+        field_value = _field_value(value, value_type)
+        if field_value is None:
+            continue
+
+        parts = [row[i_measurement].translate(_MEASUREMENT_ESCAPES)]
+        for key, i in tag_keys:
+            tag_value = row[i]
+            if tag_value:
+                parts.append(f"{key}={tag_value.translate(_KEY_ESCAPES)}")
+
+        out.append(
+            ",".join(parts)
+            + f" {row[i_field].translate(_KEY_ESCAPES)}={field_value} "
+            + str(_rfc3339_ns(row[i_time]))
+        )
+
+    return "\n".join(out)
+
+
+def convert_stream(
+    stream: Iterable[bytes], chunk_bytes: int, processes: int = env.CONVERT_PROCESSES
+) -> Iterator[tuple[str, int]]:
+    """Convert a raw flux response to line protocol in a process pool.
+
+    Args:
+        stream (Iterable[bytes]): The raw annotated csv response.
+        chunk_bytes (int): The target size of each chunk sent to a worker.
+        processes (int): The number of worker processes.
+
+    Yields:
+        (tuple[str, int]): The line protocol of each chunk, in order, with the
+        raw response size it was converted from.
+    """
+    pool = _pool_for(processes)
+    inflight: list[tuple[concurrent.futures.Future[str], int]] = []
+
+    for header, rows, raw in split_chunks(stream, chunk_bytes):
+        inflight.append((pool.submit(convert_chunk, header, rows), raw))
+        if len(inflight) >= processes * _INFLIGHT_PER_WORKER:
+            future, size = inflight.pop(0)
+            yield future.result(), size
+
+    for future, size in inflight:
+        yield future.result(), size
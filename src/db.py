@@ -3,6 +3,10 @@
 This module uses sqlalchemy to manage a database of synced databases.
 The primary objective is to track synced databases by name, and store
 the timestamp of the previous sync for that database.
+
+The tracking database is a local sqlite file by default, but may be any
+database sqlalchemy supports, shared by several workers. Workers split the
+sources between them through the lease rows in this database, see `leases`.
 """
 
 import time
@@ -13,10 +17,36 @@ import sqlalchemy.orm
 
 import env
 
-_DEFAULT_ENGINE = sqlalchemy.create_engine(env.DB)
+
+def create_engine(url: str):
+    """Create an engine for a tracking database.
+
+    Connections to server databases are pooled, checked before use, and
+    recycled periodically so idle connections dropped by the server are not
+    handed out.
+    """
+    if url.startswith("sqlite"):
+        return sqlalchemy.create_engine(url)
+    return sqlalchemy.create_engine(
+        url, pool_size=5, max_overflow=10, pool_pre_ping=True, pool_recycle=1800
+    )
+
+
+_default_engine: sqlalchemy.Engine | None = None
+
+
+def _get_default_engine():
+    """Return the engine of the tracking database, creating it on first use."""
+    global _default_engine  # pylint: disable=global-statement
+    if _default_engine is None:
+        _default_engine = create_engine(env.DB)
+    return _default_engine
 
 
-class _DbState(sqlalchemy.orm.declarative_base()):
+_Base = sqlalchemy.orm.declarative_base()
+
+
+class _DbState(_Base):
     __tablename__ = "db_state"
 
     id: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(primary_key=True)
@@ -30,6 +60,139 @@ class _DbState(sqlalchemy.orm.declarative_base()):
     )
 
 
+class _VerifiedWindow(_Base):
+    __tablename__ = "verified_window"
+
+    id: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(primary_key=True)
+
+    db_name: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        index=True, nullable=False
+    )
+
+    start_time: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+    stop_time: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+
+class _RestoredWindow(_Base):
+    __tablename__ = "restored_window"
+
+    id: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(primary_key=True)
+
+    db_name: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        index=True, nullable=False
+    )
+
+    start_time: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+    stop_time: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+
+class _ShardRoute(_Base):
+    __tablename__ = "shard_route"
+
+    id: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(primary_key=True)
+
+    destination: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        index=True, nullable=False
+    )
+
+    bucket: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        index=True, nullable=False
+    )
+
+    node: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(nullable=False)
+
+
+class _Lease(_Base):
+    __tablename__ = "lease"
+
+    id: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(primary_key=True)
+
+    name: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        unique=True, index=True, nullable=False
+    )
+
+    owner: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(nullable=False)
+
+    expires: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+
+class _Worker(_Base):
+    __tablename__ = "worker"
+
+    id: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(primary_key=True)
+
+    name: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        unique=True, index=True, nullable=False
+    )
+
+    expires: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+
+class _CatalogSeries(_Base):
+    __tablename__ = "catalog_series"
+
+    id: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(primary_key=True)
+
+    source: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        index=True, nullable=False
+    )
+
+    measurement: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+    # The tags of the series as a json object.
+    tags: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(nullable=False)
+
+    first_time: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+    last_time: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+
+class _CatalogField(_Base):
+    __tablename__ = "catalog_field"
+
+    id: sqlalchemy.orm.Mapped[int] = sqlalchemy.orm.mapped_column(primary_key=True)
+
+    source: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        index=True, nullable=False
+    )
+
+    measurement: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+    field: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(nullable=False)
+
+    type: sqlalchemy.orm.Mapped[str] = sqlalchemy.orm.mapped_column(nullable=False)
+
+    first_time: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+    last_time: sqlalchemy.orm.Mapped[float] = sqlalchemy.orm.mapped_column(
+        nullable=False
+    )
+
+
 def init_engine(
     engine: sqlalchemy.Engine | None = None,
 ):
@@ -42,13 +205,13 @@ def init_engine(
     """
 
     if engine is None:
-        engine = _DEFAULT_ENGINE
+        engine = _get_default_engine()
 
     # Give the db 5 seconds to boot, if it's not already running.
     exc: sqlalchemy.exc.SQLAlchemyError | None = None
     for _ in range(5):
         try:
-            _DbState.metadata.create_all(engine)
+            _Base.metadata.create_all(engine)
             return True
         except sqlalchemy.exc.SQLAlchemyError as e:
             time.sleep(1)
@@ -79,7 +242,7 @@ def update(
     """
 
     if engine is None:
-        engine = _DEFAULT_ENGINE
+        engine = _get_default_engine()
 
     if sync_time is None:
         sync_time = time.time()
@@ -110,7 +273,7 @@ def get_sync_time(db_name: str, engine: sqlalchemy.Engine | None = None):
         tracking database. If None (default), the default engine is used.
     """
     if engine is None:
-        engine = _DEFAULT_ENGINE
+        engine = _get_default_engine()
 
     with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
         db = session.query(_DbState).filter(_DbState.db_name == db_name).first()
@@ -119,3 +282,454 @@ def get_sync_time(db_name: str, engine: sqlalchemy.Engine | None = None):
             return 0
 
         return db.sync_time
+
+
+def add_verified_windows(
+    db_name: str,
+    windows: list[tuple[float, float]],
+    engine: sqlalchemy.Engine | None = None,
+):
+    """Record that windows of a tracked database match their source.
+
+    Args:
+        db_name (str): The name of the tracked database.
+        windows (list[tuple[float, float]]): The (start, stop) of each
+        verified window.
+        engine (Engine): The SQLAlchemy engine used to connect to the
+        tracking database. If None (default), the default engine is used.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        for start_time, stop_time in windows:
+            window = _VerifiedWindow()
+            window.db_name = db_name
+            window.start_time = start_time
+            window.stop_time = stop_time
+            session.add(window)
+        session.commit()
+
+
+def get_verified_windows(
+    db_name: str,
+    start_time: float,
+    stop_time: float,
+    engine: sqlalchemy.Engine | None = None,
+):
+    """Return the verified windows of a tracked database within a time range.
+
+    Args:
+        db_name (str): The name of the tracked database.
+        start_time (float): The start of the time range.
+        stop_time (float): The end (exclusive) of the time range.
+        engine (Engine): The SQLAlchemy engine used to connect to the
+        tracking database. If None (default), the default engine is used.
+
+    Returns:
+        (set[tuple[float, float]]): The (start, stop) of each verified window.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        windows = session.query(_VerifiedWindow).filter(
+            _VerifiedWindow.db_name == db_name,
+            _VerifiedWindow.start_time >= start_time,
+            _VerifiedWindow.stop_time <= stop_time,
+        )
+
+        return {(w.start_time, w.stop_time) for w in windows}
+
+
+def add_restored_window(
+    db_name: str,
+    start_time: float,
+    stop_time: float,
+    engine: sqlalchemy.Engine | None = None,
+):
+    """Record that a window of a source was restored from its backup.
+
+    Args:
+        db_name (str): The name of the restored source.
+        start_time (float): The start of the window.
+        stop_time (float): The end (exclusive) of the window.
+        engine (Engine): The SQLAlchemy engine used to connect to the
+        tracking database. If None (default), the default engine is used.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        window = _RestoredWindow()
+        window.db_name = db_name
+        window.start_time = start_time
+        window.stop_time = stop_time
+        session.add(window)
+        session.commit()
+
+
+def get_restored_windows(
+    db_name: str,
+    start_time: float,
+    stop_time: float,
+    engine: sqlalchemy.Engine | None = None,
+):
+    """Return the restored windows of a source overlapping a time range.
+
+    Args:
+        db_name (str): The name of the restored source.
+        start_time (float): The start of the time range.
+        stop_time (float): The end (exclusive) of the time range.
+        engine (Engine): The SQLAlchemy engine used to connect to the
+        tracking database. If None (default), the default engine is used.
+
+    Returns:
+        (list[tuple[float, float]]): The (start, stop) of each restored
+        window, sorted.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        windows = session.query(_RestoredWindow).filter(
+            _RestoredWindow.db_name == db_name,
+            _RestoredWindow.stop_time > start_time,
+            _RestoredWindow.start_time < stop_time,
+        )
+
+        return sorted((w.start_time, w.stop_time) for w in windows)
+
+
+def clear_restored_windows(db_name: str, engine: sqlalchemy.Engine | None = None):
+    """Forget the restored windows of a source, once its restore is complete."""
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        session.execute(
+            sqlalchemy.delete(_RestoredWindow).where(
+                _RestoredWindow.db_name == db_name
+            )
+        )
+        session.commit()
+
+
+def get_catalog(source: str, engine: sqlalchemy.Engine | None = None):
+    """Return the recorded schema of a source, see `catalog`.
+
+    Args:
+        source (str): The name of the source.
+        engine (Engine): The SQLAlchemy engine used to connect to the
+        tracking database. If None (default), the default engine is used.
+
+    Returns:
+        (tuple[list[tuple[str, str, float, float]], list[tuple[str, str, str,
+        float, float]]]): The (measurement, tags as json, first time, last
+        time) of every series, and the (measurement, field, type, first time,
+        last time) of every field.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        series = [
+            (s.measurement, s.tags, s.first_time, s.last_time)
+            for s in session.query(_CatalogSeries).filter(
+                _CatalogSeries.source == source
+            )
+        ]
+        fields = [
+            (f.measurement, f.field, f.type, f.first_time, f.last_time)
+            for f in session.query(_CatalogField).filter(
+                _CatalogField.source == source
+            )
+        ]
+        return series, fields
+
+
+def update_catalog(
+    source: str,
+    series: list[tuple[str, str, float, float]],
+    fields: list[tuple[str, str, str, float, float]],
+    engine: sqlalchemy.Engine | None = None,
+):
+    """Record observed series and fields in the schema of a source.
+
+    Unrecorded series and fields are added. Recorded ones keep the earliest
+    first time and the latest last time, and fields take the observed type.
+
+    Args:
+        source (str): The name of the source.
+        series (list[tuple[str, str, float, float]]): The (measurement, tags
+        as json, first time, last time) of every observed series.
+        fields (list[tuple[str, str, str, float, float]]): The (measurement,
+        field, type, first time, last time) of every observed field.
+        engine (Engine): The SQLAlchemy engine used to connect to the
+        tracking database. If None (default), the default engine is used.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    measurements = {row[0] for row in series} | {row[0] for row in fields}
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        recorded_series = {
+            (s.measurement, s.tags): s
+            for s in session.query(_CatalogSeries).filter(
+                _CatalogSeries.source == source,
+                _CatalogSeries.measurement.in_(measurements),
+            )
+        }
+        for measurement, tags, first_time, last_time in series:
+            row = recorded_series.get((measurement, tags))
+            if row is None:
+                row = _CatalogSeries()
+                row.source = source
+                row.measurement = measurement
+                row.tags = tags
+                row.first_time = first_time
+                row.last_time = last_time
+                session.add(row)
+                recorded_series[(measurement, tags)] = row
+            else:
+                row.first_time = min(row.first_time, first_time)
+                row.last_time = max(row.last_time, last_time)
+
+        recorded_fields = {
+            (f.measurement, f.field): f
+            for f in session.query(_CatalogField).filter(
+                _CatalogField.source == source,
+                _CatalogField.measurement.in_(measurements),
+            )
+        }
+        for measurement, field, field_type, first_time, last_time in fields:
+            row = recorded_fields.get((measurement, field))
+            if row is None:
+                row = _CatalogField()
+                row.source = source
+                row.measurement = measurement
+                row.field = field
+                row.first_time = first_time
+                row.last_time = last_time
+                session.add(row)
+                recorded_fields[(measurement, field)] = row
+            else:
+                row.first_time = min(row.first_time, first_time)
+                row.last_time = max(row.last_time, last_time)
+            row.type = field_type
+
+        session.commit()
+
+
+def get_routes(
+    destination: str,
+    bucket: str,
+    engine: sqlalchemy.Engine | None = None,
+):
+    """Return the nodes a bucket of a sharded destination is stored on.
+
+    Args:
+        destination (str): The name of the sharded destination.
+        bucket (str): The name of the bucket.
+        engine (Engine): The SQLAlchemy engine used to connect to the
+        tracking database. If None (default), the default engine is used.
+
+    Returns:
+        (list[str]): The names of the nodes, empty if the bucket has not been
+        routed yet.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        routes = session.query(_ShardRoute).filter(
+            _ShardRoute.destination == destination,
+            _ShardRoute.bucket == bucket,
+        )
+
+        return sorted(r.node for r in routes)
+
+
+def set_routes(
+    destination: str,
+    bucket: str,
+    nodes: list[str],
+    engine: sqlalchemy.Engine | None = None,
+):
+    """Record the nodes a bucket of a sharded destination is stored on.
+
+    Any previously recorded nodes of the bucket are replaced.
+
+    Args:
+        destination (str): The name of the sharded destination.
+        bucket (str): The name of the bucket.
+        nodes (list[str]): The names of the nodes.
+        engine (Engine): The SQLAlchemy engine used to connect to the
+        tracking database. If None (default), the default engine is used.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        session.query(_ShardRoute).filter(
+            _ShardRoute.destination == destination,
+            _ShardRoute.bucket == bucket,
+        ).delete()
+        for node in nodes:
+            route = _ShardRoute()
+            route.destination = destination
+            route.bucket = bucket
+            route.node = node
+            session.add(route)
+        session.commit()
+
+
+def claim_lease(
+    name: str,
+    owner: str,
+    ttl: float,
+    engine: sqlalchemy.Engine | None = None,
+):
+    """Claim or renew the lease of a source.
+
+    The lease is taken if it does not exist, has expired, or is already held
+    by `owner`. Claims are atomic, so two workers never both succeed.
+
+    Args:
+        name (str): The name of the leased source.
+        owner (str): The name of the claiming worker.
+        ttl (float): Seconds until the lease expires unless renewed.
+        engine (Engine): The SQLAlchemy engine used to connect to the
+        tracking database. If None (default), the default engine is used.
+
+    Returns:
+        (bool): True if `owner` now holds the lease.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    now = time.time()
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        result = session.execute(
+            sqlalchemy.update(_Lease)
+            .where(
+                _Lease.name == name,
+                sqlalchemy.or_(_Lease.owner == owner, _Lease.expires < now),
+            )
+            .values(owner=owner, expires=now + ttl)
+        )
+        session.commit()
+        if result.rowcount:  # type: ignore
+            return True
+
+        if session.query(_Lease).filter(_Lease.name == name).first() is not None:
+            return False
+
+        lease = _Lease()
+        lease.name = name
+        lease.owner = owner
+        lease.expires = now + ttl
+        session.add(lease)
+        try:
+            session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # Another worker created the lease first.
+            session.rollback()
+            return False
+        return True
+
+
+def renew_leases(
+    names: set[str],
+    owner: str,
+    ttl: float,
+    engine: sqlalchemy.Engine | None = None,
+):
+    """Extend the leases held by `owner`.
+
+    Unlike `claim_lease`, a lease that was released or taken over is not
+    created or claimed again.
+
+    Returns:
+        (set[str]): The names of the leases that are still held.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    kept: set[str] = set()
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        for name in names:
+            result = session.execute(
+                sqlalchemy.update(_Lease)
+                .where(_Lease.name == name, _Lease.owner == owner)
+                .values(expires=time.time() + ttl)
+            )
+            if result.rowcount:  # type: ignore
+                kept.add(name)
+        session.commit()
+    return kept
+
+
+def release_lease(name: str, owner: str, engine: sqlalchemy.Engine | None = None):
+    """Give up a lease held by `owner`, so another worker can claim it at once."""
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        session.execute(
+            sqlalchemy.delete(_Lease).where(_Lease.name == name, _Lease.owner == owner)
+        )
+        session.commit()
+
+
+def get_lease_owners(engine: sqlalchemy.Engine | None = None):
+    """Return the owner of every lease that has not expired.
+
+    Returns:
+        (dict[str, str]): The owning worker, keyed by leased source name.
+    """
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        leases = session.query(_Lease).filter(_Lease.expires >= time.time())
+        return {lease.name: lease.owner for lease in leases}
+
+
+def heartbeat_worker(name: str, ttl: float, engine: sqlalchemy.Engine | None = None):
+    """Record that a worker is alive for the next `ttl` seconds."""
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        worker = session.query(_Worker).filter(_Worker.name == name).first()
+
+        if worker is None:
+            worker = _Worker()
+            worker.name = name
+            session.add(worker)
+        worker.expires = time.time() + ttl
+
+        session.commit()
+
+
+def remove_worker(name: str, engine: sqlalchemy.Engine | None = None):
+    """Remove a worker that is shutting down, along with its leases."""
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        session.execute(sqlalchemy.delete(_Worker).where(_Worker.name == name))
+        session.execute(sqlalchemy.delete(_Lease).where(_Lease.owner == name))
+        session.commit()
+
+
+def get_live_workers(engine: sqlalchemy.Engine | None = None):
+    """Return the names of every worker whose heartbeat has not expired."""
+    if engine is None:
+        engine = _get_default_engine()
+
+    with sqlalchemy.orm.Session(engine, expire_on_commit=False) as session:
+        workers = session.query(_Worker).filter(_Worker.expires >= time.time())
+        return sorted(w.name for w in workers)
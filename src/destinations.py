@@ -0,0 +1,602 @@
+"""Module providing the destinations that synced data is written to.
+
+A source can be backed up to several destinations at once. Every batch is
+read and converted once, then fanned out to one worker thread per
+destination. A destination that fails, or falls too far behind another one
+that has caught up, is detached for the rest of the sync so it never blocks
+the others. If every destination is behind, reading simply waits for them.
+Each destination keeps its own sync time in the tracking database, advanced
+after every partition it completes, so a detached destination catches up on
+later syncs.
+
+Writes to influxdb destinations go through the shared bucket queues of
+`coalescer`, so small batches of concurrent syncs are written together.
+"""
+
+import abc
+import concurrent.futures
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable
+from typing import Any, NamedTuple
+
+import influxdb_client
+import influxdb_client.client.flux_table
+import pydantic
+import urllib3.exceptions
+
+import coalescer
+import env
+import memory
+
+# Number of batches a destination may fall behind before it may be detached.
+_QUEUE_DEPTH = 16
+
+# Seconds to wait for the memory budget between checks for lagging destinations.
+_BUDGET_WAIT = 0.5
+
+# Seconds to wait for room in a full queue before checking the destinations again.
+_OFFER_WAIT = 0.5
+
+# Name of the destination every source is backed up to by default. Its sync
+# time is tracked under the plain source name.
+DEFAULT_NAME = "local"
+
+
+class Batch(NamedTuple):
+    """A batch of records read from a source, with their line protocol.
+
+    Batches converted in a process pool carry no records, and each entry of
+    `lines` may hold many newline separated lines.
+    """
+
+    records: list[influxdb_client.client.flux_table.FluxRecord]
+    lines: list[str]
+    # Estimated memory held by the batch.
+    nbytes: int = 0
+
+
+class InfluxDestination(pydantic.BaseModel):
+    """Model representing an influxdb destination.
+
+    If `bucket` is not set, the name of the source is used.
+    """
+
+    name: str
+    url: str
+    token: str
+    org: str
+    bucket: str | None = None
+
+
+class ArchiveDestination(pydantic.BaseModel):
+    """Model representing a local file archive destination."""
+
+    name: str
+    path: str
+
+
+class InfluxNode(pydantic.BaseModel):
+    """Model representing one influxdb node of a sharded destination."""
+
+    name: str
+    url: str
+    token: str
+    org: str
+
+
+class ShardedDestination(pydantic.BaseModel):
+    """Model representing buckets spread over several influxdb nodes.
+
+    Each bucket is stored on `replicas` of the nodes, see `sharding`. If
+    `bucket` is not set, the name of the source is used.
+    """
+
+    name: str
+    nodes: list[InfluxNode]
+    replicas: int = 1
+    bucket: str | None = None
+
+
+Destination = InfluxDestination | ArchiveDestination | ShardedDestination
+
+
+def default_destinations(
+    nodes: list[InfluxNode] | None = None, replicas: int = 1
+) -> list[Destination]:
+    """Return the destinations of a source that does not configure any.
+
+    If local `nodes` are configured, the default destination is sharded over
+    them instead of written to LOCAL_IDB_URL.
+    """
+    dests: list[Destination] = []
+    if nodes:
+        dests.append(
+            ShardedDestination(name=DEFAULT_NAME, nodes=nodes, replicas=replicas)
+        )
+    else:
+        dests.append(
+            InfluxDestination(
+                name=DEFAULT_NAME,
+                url=env.LOCAL_IDB_URL,
+                token="12345678=",
+                org="maybell",
+            )
+        )
+    if env.ARCHIVEDIR is not None:
+        dests.append(ArchiveDestination(name="archive", path=env.ARCHIVEDIR))
+    return dests
+
+
+def tracking_name(source_name: str, dest: Destination):
+    """Return the name a destination's sync time is tracked under."""
+    if dest.name == DEFAULT_NAME:
+        return source_name
+    return f"{source_name}/{dest.name}"
+
+
+def validate_nodes(nodes: Any):
+    """Validate a list of influxdb node configuration objects."""
+    if not isinstance(nodes, list) or not nodes:
+        raise RuntimeError(
+            "'nodes' must be a non-empty list of node configuration objects, "
+            + f"not {nodes}"
+        )
+
+    result: list[InfluxNode] = []
+    for node in nodes:  # type: ignore
+        if not isinstance(node, dict):
+            raise RuntimeError(
+                "Each node must be a node configuration object containing a "
+                + "'name', 'url', 'token' and 'org'."
+            )
+        try:
+            result.append(InfluxNode(**node))  # type: ignore
+        except pydantic.ValidationError as e:
+            name = node.get("name")  # type: ignore
+            raise RuntimeError(f"Node '{name}' is invalid: {e}") from e
+
+    names = [node.name for node in result]
+    if len(set(names)) != len(names):
+        raise RuntimeError("Node names must be unique.")
+
+    return result
+
+
+def validate_replicas(replicas: Any, nodes: list[InfluxNode]):
+    """Validate the replication factor of a sharded destination."""
+    if (
+        not isinstance(replicas, int)
+        or isinstance(replicas, bool)
+        or not 1 <= replicas <= len(nodes)
+    ):
+        raise RuntimeError(
+            "'replicas' must be an integer between 1 and the number of nodes "
+            + f"({len(nodes)})."
+        )
+    return replicas
+
+
+def validate_destinations(destinations: Any):
+    """Validate the 'destinations' list of a source configuration object."""
+    if not isinstance(destinations, list):
+        raise RuntimeError(
+            "'destinations' of a source must be a list of destination "
+            + f"configuration objects, not {type(destinations)}"
+        )
+
+    dests: list[Destination] = []
+    names: set[str] = set()
+
+    for dest in destinations:  # type: ignore
+        if not isinstance(dest, dict):
+            raise RuntimeError(
+                "Each destination must be a destination configuration object "
+                + "containing a 'name' and 'type'."
+            )
+
+        name = dest.get("name")  # type: ignore
+        dest_type = dest.get("type", "influxdb")  # type: ignore
+
+        if not isinstance(name, str):
+            raise RuntimeError(
+                "Destination configuration object must contain a 'name' of type string"
+            )
+        if name in names:
+            raise RuntimeError(f"Destination name '{name}' is used more than once.")
+        names.add(name)
+
+        try:
+            match dest_type:
+                case "influxdb":
+                    dests.append(InfluxDestination(**dest))  # type: ignore
+                case "archive":
+                    dests.append(ArchiveDestination(**dest))  # type: ignore
+                case "sharded":
+                    nodes = validate_nodes(dest.get("nodes"))  # type: ignore
+                    replicas = validate_replicas(
+                        dest.get("replicas", 1), nodes  # type: ignore
+                    )
+                    dests.append(
+                        ShardedDestination(
+                            name=name,
+                            nodes=nodes,
+                            replicas=replicas,
+                            bucket=dest.get("bucket"),  # type: ignore
+                        )
+                    )
+                case _:
+                    raise RuntimeError(
+                        f"Destination '{name}' has unknown type '{dest_type}'. "
+                        + "Expected 'influxdb', 'archive' or 'sharded'."
+                    )
+        except pydantic.ValidationError as e:
+            raise RuntimeError(f"Destination '{name}' is invalid: {e}") from e
+
+    return dests
+
+
+# (url, bucket) pairs known to exist, so the check is not repeated every sync.
+_known_buckets: set[tuple[str, str]] = set()
+
+
+def ensure_bucket_exists(bucket: str, client: influxdb_client.InfluxDBClient):
+    """Ensure that the bucket `bucket` exists in `client`'s database.
+
+    If `bucket` is not found, it is created. Buckets that were found or
+    created are cached, and are not checked again unless a write to them
+    fails.
+
+    Returns:
+        (bool): True if the bucket was successfully created, False otherwise.
+    """
+    key = (client.url, bucket)
+    if key in _known_buckets:
+        return True
+
+    buckets_api = client.buckets_api()
+
+    # Give the db 5 seconds to boot, if it's not already running.
+    for _ in range(5):
+        try:
+            if buckets_api.find_bucket_by_name(bucket) is None:
+                buckets_api.create_bucket(bucket_name=bucket)
+            _known_buckets.add(key)
+            return True
+        except urllib3.exceptions.HTTPError:
+            time.sleep(1)
+
+    return False
+
+
+class Writer(abc.ABC):
+    """Writes batches to a single destination."""
+
+    @abc.abstractmethod
+    def write(self, batch: Batch):
+        """Write a batch to the destination."""
+
+    def close(self):
+        """Release any resources held by the writer."""
+
+
+def influx_targets(dest: InfluxDestination | ShardedDestination, source_name: str):
+    """Return the influxdb buckets that data synced from `source_name` is written to.
+
+    A sharded destination is resolved to the nodes its bucket is routed to.
+    Every returned destination has its bucket set.
+    """
+    bucket = dest.bucket if dest.bucket is not None else source_name
+    if isinstance(dest, InfluxDestination):
+        return [dest.model_copy(update={"bucket": bucket})]
+
+    import sharding  # pylint: disable=import-outside-toplevel
+
+    nodes = {node.name: node for node in dest.nodes}
+    routed = sharding.route(dest.name, bucket, list(nodes), dest.replicas)
+    return [
+        InfluxDestination(
+            name=f"{dest.name}/{name}",
+            url=nodes[name].url,
+            token=nodes[name].token,
+            org=nodes[name].org,
+            bucket=bucket,
+        )
+        for name in routed
+    ]
+
+
+class _InfluxWriter(Writer):
+    def __init__(self, dest: InfluxDestination, source_name: str):
+        self.dest = dest
+        self.bucket = dest.bucket if dest.bucket is not None else source_name
+        self.client = coalescer.client(dest.url, dest.token, dest.org)
+        if not ensure_bucket_exists(self.bucket, self.client):
+            raise IOError(f"Could not find or create bucket '{self.bucket}'")
+        coalescer.attach(dest.url, dest.token, dest.org, self.bucket)
+
+    def submit(self, batch: Batch):
+        """Queue a batch, returning a future to pass to `wait`."""
+        return coalescer.submit(
+            self.dest.url, self.dest.token, self.dest.org, self.bucket, batch.lines
+        )
+
+    def wait(self, future: concurrent.futures.Future[None]):
+        """Wait until a batch queued by `submit` is written."""
+        try:
+            future.result()
+        except IOError:
+            # The bucket may have been deleted, so check for it again next time.
+            _known_buckets.discard((self.client.url, self.bucket))
+            raise
+
+    def write(self, batch: Batch):
+        # Returns once the batch is written, possibly together with batches of
+        # other syncs to the same bucket.
+        self.wait(self.submit(batch))
+
+    def close(self):
+        coalescer.detach(self.dest.url, self.dest.token, self.dest.org, self.bucket)
+
+
+class _ShardedWriter(Writer):
+    def __init__(self, dest: ShardedDestination, source_name: str):
+        self.writers: list[_InfluxWriter] = []
+        try:
+            for target in influx_targets(dest, source_name):
+                self.writers.append(_InfluxWriter(target, source_name))
+        except Exception:
+            self.close()
+            raise
+
+    def write(self, batch: Batch):
+        # Replicas are written concurrently.
+        futures = [(writer, writer.submit(batch)) for writer in self.writers]
+        for writer, future in futures:
+            writer.wait(future)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class _ArchiveWriter(Writer):
+    def __init__(self, dest: ArchiveDestination, source_name: str):
+        self.path = dest.path
+        self.source_name = source_name
+
+    def write(self, batch: Batch):
+        import archive  # pylint: disable=import-outside-toplevel
+
+        archive.append_records(self.path, self.source_name, batch.records)
+
+
+def open_writer(dest: Destination, source_name: str) -> Writer:
+    """Return a writer for `dest`, writing data synced from `source_name`."""
+    if isinstance(dest, InfluxDestination):
+        return _InfluxWriter(dest, source_name)
+    if isinstance(dest, ShardedDestination):
+        return _ShardedWriter(dest, source_name)
+    return _ArchiveWriter(dest, source_name)
+
+
+class _Pending:
+    """A batch shared by the workers it was queued to.
+
+    The batch's share of the memory budget is released once every worker has
+    written or dropped it.
+    """
+
+    def __init__(self, batch: Batch, taken: int):
+        self.batch = batch
+        self.taken = taken
+        # The bytes taken, kept after they are released.
+        self.nbytes = taken
+        self.remaining = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        """Count one more worker the batch is queued to."""
+        with self._lock:
+            self.remaining += 1
+
+    def done(self):
+        """Mark the batch written or dropped by one worker."""
+        with self._lock:
+            self.remaining -= 1
+            last = self.remaining <= 0
+        if last and self.taken:
+            memory.BUDGET.release(self.taken)
+            self.taken = 0
+
+
+class _Worker(threading.Thread):
+    """Thread writing the batches queued for a single destination."""
+
+    def __init__(self, name: str, open_fn: Callable[[], Writer]):
+        super().__init__(name=f"destination-{name}", daemon=True)
+        self.dest_name = name
+        self.open_fn = open_fn
+        self.queue: queue.Queue[_Pending | None] = queue.Queue(_QUEUE_DEPTH)
+        self.error: Exception | None = None
+        self.detached = False
+        # Budget bytes of the batches queued to the worker and not yet written.
+        self.held = 0
+        self._held_lock = threading.Lock()
+
+    def hold(self, nbytes: int):
+        """Count `nbytes` more, or fewer if negative, as held by the worker."""
+        with self._held_lock:
+            self.held += nbytes
+
+    def _finish(self, pending: _Pending):
+        pending.done()
+        self.hold(-pending.nbytes)
+
+    def run(self):
+        writer: Writer | None = None
+        try:
+            writer = self.open_fn()
+            while (pending := self.queue.get()) is not None:
+                try:
+                    writer.write(pending.batch)
+                finally:
+                    self._finish(pending)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.error = e
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def drain(self):
+        """Drop every queued batch."""
+        try:
+            while True:
+                pending = self.queue.get_nowait()
+                if pending is not None:
+                    self._finish(pending)
+        except queue.Empty:
+            pass
+
+    def detach(self, error: Exception | None = None):
+        """Drop any queued batches and stop the worker after its current batch."""
+        self.detached = True
+        if error is not None:
+            self.error = error
+        self.drain()
+        self.queue.put_nowait(None)
+
+
+def _acquire(batch: Batch, workers: list[_Worker]):
+    """Take the batch's share of the memory budget.
+
+    If the budget is exhausted while one destination holds more than its
+    share of it in unwritten batches and another holds less, the lagging
+    destination is detached, so a slow destination does not pace the others.
+    Destinations that are all behind, or a single one, are waited for.
+
+    Workers that failed no longer drain their queues, so they are detached,
+    releasing their queued batches, however many destinations are attached.
+
+    Returns:
+        (int): The bytes taken, 0 if every destination is detached.
+    """
+    # Destinations are checked as soon as the budget is exhausted, since a
+    # slow destination that still makes progress frees it again shortly.
+    timeout = 0.0
+    while (taken := memory.BUDGET.acquire(batch.nbytes, timeout)) is None:
+        timeout = _BUDGET_WAIT
+        for w in workers:
+            if not w.detached and (w.error is not None or not w.is_alive()):
+                w.detach()
+        attached = [w for w in workers if not w.detached]
+        if not attached:
+            return 0
+        if len(attached) < 2:
+            continue
+        share = memory.BUDGET.capacity / len(attached)
+        laggard = max(attached, key=lambda w: w.held)
+        if laggard.held > share and any(
+            w is not laggard and w.held < share for w in attached
+        ):
+            print(f"Destination '{laggard.dest_name}' fell behind, detaching.")
+            laggard.detach(IOError("Destination fell behind"))
+    return taken
+
+
+def _offer(pending: _Pending, worker: _Worker, workers: list[_Worker]):
+    """Queue a batch to a worker, unless it fell behind the other destinations.
+
+    A worker with a full queue is only detached if another attached worker
+    keeps up, with room left in its queue. If every destination is behind,
+    including a single destination that is simply slower than the reader,
+    reading waits for them instead.
+
+    Returns:
+        (bool): True if the batch was queued.
+    """
+    worker.hold(pending.nbytes)
+    try:
+        worker.queue.put_nowait(pending)
+        return True
+    except queue.Full:
+        pass
+
+    while True:
+        if worker.error is not None or not worker.is_alive():
+            worker.hold(-pending.nbytes)
+            worker.detach()
+            return False
+        if any(
+            w is not worker and not w.detached and not w.queue.full() for w in workers
+        ):
+            worker.hold(-pending.nbytes)
+            print(f"Destination '{worker.dest_name}' fell behind, detaching.")
+            worker.detach(IOError("Destination fell behind"))
+            return False
+        try:
+            worker.queue.put(pending, timeout=_OFFER_WAIT)
+            return True
+        except queue.Full:
+            pass
+
+
+def fan_out(batches: Iterable[Batch], writers: dict[str, Callable[[], Writer]]):
+    """Write every batch to every destination concurrently.
+
+    Every batch holds its estimated size against the global memory budget
+    until all destinations have written it.
+
+    Args:
+        batches (Iterable[Batch]): The batches to write, in order.
+        writers (dict[str, Callable[[], Writer]]): Factories opening a writer
+        for each destination, keyed by destination name. Writers are opened in
+        their worker thread, so a destination that is down does not delay the
+        others.
+
+    Returns:
+        (dict[str, Exception | None]): For every destination, None if it
+        received every batch, otherwise the reason it was detached.
+    """
+    workers = [_Worker(name, open_fn) for name, open_fn in writers.items()]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for batch in batches:
+            pending = _Pending(batch, _acquire(batch, workers))
+            # Held until every worker has been offered the batch.
+            pending.add()
+            for worker in workers:
+                if worker.detached:
+                    continue
+                if worker.error is not None:
+                    worker.detach()
+                    continue
+                pending.add()
+                if not _offer(pending, worker, workers):
+                    pending.done()
+            pending.done()
+
+            if all(worker.detached for worker in workers):
+                break
+    finally:
+        for worker in workers:
+            while not worker.detached:
+                try:
+                    worker.queue.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    # A worker that failed no longer drains its queue.
+                    if worker.error is not None:
+                        worker.detach()
+
+    for worker in workers:
+        if not worker.detached:
+            worker.join()
+        # Release batches left behind by workers that failed.
+        if not worker.is_alive():
+            worker.drain()
+
+    return {worker.dest_name: worker.error for worker in workers}
@@ -1,7 +1,35 @@
 """Module providing global constants from the environment."""
 
 import os
+import socket
 
 DBDIR = os.environ.get("DBDIR", os.path.expanduser("~/.centraldb"))
-DB = "sqlite:///" + os.path.join(DBDIR, "tracking.db")
+# SQLAlchemy url of the tracking database. Set it to a shared database, for
+# example postgresql://..., to run several workers against the same fleet.
+DB = os.environ.get("TRACKING_DB", "sqlite:///" + os.path.join(DBDIR, "tracking.db"))
+# Name this worker holds source leases under.
+WORKER_ID = os.environ.get("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+# Seconds a source lease is valid for without being renewed.
+LEASE_TTL = float(os.environ.get("LEASE_TTL", 120))
 LOCAL_IDB_URL = os.environ.get("LOCAL_IDB_URL", "http://localhost:8086")
+# Directory of the local archive. Synced data is only archived if this is set.
+ARCHIVEDIR = os.environ.get("ARCHIVEDIR")
+# Days after which archive partitions are compacted. Compacted partitions are
+# smaller but decoded in memory on every read, so this is disabled if unset.
+ARCHIVE_COMPACT_DAYS = (
+    float(os.environ["ARCHIVE_COMPACT_DAYS"])
+    if os.environ.get("ARCHIVE_COMPACT_DAYS")
+    else None
+)
+# Bytes of memory that in-flight sync batches may hold at once.
+MEMORY_BUDGET = int(os.environ.get("MEMORY_BUDGET", 256 * 2**20))
+# Report the tracemalloc high-water mark of every sync if set.
+MEMORY_TRACE = bool(os.environ.get("MEMORY_TRACE"))
+# Number of worker processes converting raw responses. 0 converts in process.
+CONVERT_PROCESSES = int(os.environ.get("CONVERT_PROCESSES", 0))
+# Maximum number of syncs in flight at once in the asyncio runtime.
+ASYNC_CONCURRENCY = int(os.environ.get("ASYNC_CONCURRENCY", 64))
+# Port serving the latest value of every series over http. Disabled if unset.
+LATEST_PORT = int(os.environ["LATEST_PORT"]) if os.environ.get("LATEST_PORT") else None
+# File the latest value cache is saved to after every sync cycle, if set.
+LATEST_SNAPSHOT = os.environ.get("LATEST_SNAPSHOT")
@@ -0,0 +1,173 @@
+"""Module providing per source filters that are pushed down into flux queries.
+
+Filters are configured per source in sources.yaml, for example:
+
+    filter:
+      include:
+        measurements: [thermometer, pressure]
+      exclude:
+        fields: [quadrature, inverter.alarm]
+        tags:
+          sensor: [prp]
+
+Fields may be qualified by their measurement as "<measurement>.<field>".
+Every rule is compiled into its own flux `filter()`. Measurement, field and
+tag include rules only use (in)equality comparisons, so the source's storage
+engine can apply them before any data is read or sent over the network.
+
+Tag excludes keep series that do not have the tag at all, which needs an
+`exists` check that storage may not push down. Those filters therefore come
+last, after every filter that can be pushed down, and are evaluated by flux
+on the data the earlier filters let through.
+"""
+
+from typing import Any
+
+import pydantic
+
+_SECTIONS = ("include", "exclude")
+_KEYS = ("measurements", "fields", "tags")
+
+
+class SourceFilter(pydantic.BaseModel):
+    """Model representing the include and exclude rules of a source."""
+
+    include_measurements: list[str] = []
+    exclude_measurements: list[str] = []
+    include_fields: list[str] = []
+    exclude_fields: list[str] = []
+    include_tags: dict[str, list[str]] = {}
+    exclude_tags: dict[str, list[str]] = {}
+
+
+def _string_list(value: Any, where: str) -> list[str]:
+    if not isinstance(value, list) or not all(
+        isinstance(v, str) for v in value  # type: ignore
+    ):
+        raise RuntimeError(f"Filter '{where}' must be a list of strings.")
+    return value  # type: ignore
+
+
+def validate_filter(value: Any):
+    """Validate the 'filter' object of a source configuration object."""
+    if not isinstance(value, dict):
+        raise RuntimeError(
+            f"'filter' of a source must be a dict, not {type(value)}"  # type: ignore
+        )
+
+    rules: dict[str, Any] = {}
+    for section, body in value.items():  # type: ignore
+        if section not in _SECTIONS:
+            raise RuntimeError(
+                f"Unknown filter section '{section}'. Expected one of {_SECTIONS}"
+            )
+        if not isinstance(body, dict):
+            raise RuntimeError(f"Filter section '{section}' must be a dict.")
+
+        for key, rule in body.items():  # type: ignore
+            where = f"{section}.{key}"
+            match key:
+                case "measurements" | "fields":
+                    rules[f"{section}_{key}"] = _string_list(rule, where)
+                case "tags":
+                    if not isinstance(rule, dict):
+                        raise RuntimeError(
+                            f"Filter '{where}' must map tag keys to lists of values."
+                        )
+                    rules[f"{section}_tags"] = {
+                        str(tag): _string_list(values, f"{where}.{tag}")
+                        for tag, values in rule.items()  # type: ignore
+                    }
+                case _:
+                    raise RuntimeError(
+                        f"Unknown filter rule '{where}'. Expected one of {_KEYS}"
+                    )
+
+    return SourceFilter(**rules)
+
+
+def _flux_string(value: str):
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("${", "\\${")
+    return f'"{escaped}"'
+
+
+def _column(name: str):
+    return f"r[{_flux_string(name)}]"
+
+
+def _field_match(field: str):
+    """Return a predicate matching a, possibly measurement qualified, field."""
+    measurement, sep, name = field.partition(".")
+    if not sep:
+        return f"r._field == {_flux_string(field)}"
+    return (
+        f"(r._measurement == {_flux_string(measurement)} "
+        + f"and r._field == {_flux_string(name)})"
+    )
+
+
+def _field_mismatch(field: str):
+    measurement, sep, name = field.partition(".")
+    if not sep:
+        return f"r._field != {_flux_string(field)}"
+    return (
+        f"(r._measurement != {_flux_string(measurement)} "
+        + f"or r._field != {_flux_string(name)})"
+    )
+
+
+def to_flux(source_filter: SourceFilter):
+    """Compile a source filter into flux `filter()` calls.
+
+    Returns:
+        (str): Zero or more "|> filter(...)" lines, to be placed directly after
+        `range()`.
+    """
+    predicates: list[str] = []
+
+    if source_filter.include_measurements:
+        predicates.append(
+            " or ".join(
+                f"r._measurement == {_flux_string(m)}"
+                for m in source_filter.include_measurements
+            )
+        )
+    if source_filter.exclude_measurements:
+        predicates.append(
+            " and ".join(
+                f"r._measurement != {_flux_string(m)}"
+                for m in source_filter.exclude_measurements
+            )
+        )
+    if source_filter.include_fields:
+        predicates.append(
+            " or ".join(_field_match(f) for f in source_filter.include_fields)
+        )
+    if source_filter.exclude_fields:
+        predicates.append(
+            " and ".join(_field_mismatch(f) for f in source_filter.exclude_fields)
+        )
+    for tag, values in source_filter.include_tags.items():
+        if not values:
+            continue
+        predicates.append(
+            " or ".join(f"{_column(tag)} == {_flux_string(v)}" for v in values)
+        )
+    for tag, values in source_filter.exclude_tags.items():
+        if not values:
+            continue
+        # Series without the tag are not excluded. A bare != would drop them
+        # when flux evaluates it, but keep them when storage does, so the
+        # exists check is needed even though it may not be pushed down.
+        predicates.append(
+            f"not exists {_column(tag)} or "
+            + "("
+            + " and ".join(f"{_column(tag)} != {_flux_string(v)}" for v in values)
+            + ")"
+        )
+
+    return "".join(
+        f"\n    |> filter(fn: (r) => {predicate})"
+        for predicate in predicates
+        if predicate
+    )
@@ -0,0 +1,145 @@
+"""Module providing helpers for inspecting and converting flux query records.
+
+Also parses the line protocol records are converted to, for modules that
+only see converted batches, such as those of process conversion.
+"""
+
+import datetime
+
+import influxdb_client
+import influxdb_client.client.flux_table
+
+# Columns added to every flux record that are not tags of the series.
+NON_TAG_COLUMNS = frozenset(
+    [
+        "_measurement",
+        "_field",
+        "_value",
+        "_time",
+        "result",
+        "table",
+        "_stop",
+        "_start",
+    ]
+)
+
+# Tags of a series as sorted (key, value) pairs.
+Tags = tuple[tuple[str, str], ...]
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def record_tags(record: influxdb_client.client.flux_table.FluxRecord):
+    """Return the tags of a record as a sorted tuple of (key, value) pairs."""
+    return tuple(
+        sorted(
+            (key, str(value))
+            for key, value in record.values.items()
+            if key not in NON_TAG_COLUMNS
+        )
+    )
+
+
+def time_ns(t: datetime.datetime):
+    """Return a timezone aware datetime as integer nanoseconds since the epoch."""
+    return (t - _EPOCH) // _MICROSECOND * 1000
+
+
+def record_to_point(record: influxdb_client.client.flux_table.FluxRecord):
+    """Convert a FluxRecord into a Point."""
+    point = influxdb_client.Point(record.get_measurement())
+
+    point.time(record.get_time())
+    point.field(record.get_field(), record.get_value())
+
+    for key, value in record.values.items():
+        if key not in NON_TAG_COLUMNS:
+            point = point.tag(key, value)
+
+    return point
+
+
+def _unescape(s: str):
+    if "\\" not in s:
+        return s
+    out: list[str] = []
+    i = 0
+    while i < len(s):
+        if s[i] == "\\" and i + 1 < len(s):
+            i += 1
+        out.append(s[i])
+        i += 1
+    return "".join(out)
+
+
+def _split_unescaped(s: str, sep: str, maxsplit: int = -1):
+    """Split `s` on every `sep` not escaped by a backslash, or inside quotes."""
+    if "\\" not in s and '"' not in s:
+        return s.split(sep, maxsplit)
+    parts: list[str] = []
+    start = 0
+    quoted = False
+    i = 0
+    while i < len(s) and (maxsplit < 0 or len(parts) < maxsplit):
+        c = s[i]
+        if c == "\\":
+            i += 1
+        elif c == '"':
+            quoted = not quoted
+        elif c == sep and not quoted:
+            parts.append(s[start:i])
+            start = i + 1
+        i += 1
+    parts.append(s[start:])
+    return parts
+
+
+def _field_value(value: str):
+    """Return a line protocol field value as a python value."""
+    if value.startswith('"'):
+        return _unescape(value[1:-1])
+    if value in ("t", "T", "true", "True", "TRUE"):
+        return True
+    if value in ("f", "F", "false", "False", "FALSE"):
+        return False
+    if value.endswith(("i", "u")):
+        return int(value[:-1])
+    return float(value)
+
+
+def series_key(line: str):
+    """Return a key of the series and field of a line of line protocol.
+
+    The key is the line up to its field value, found without parsing it. A
+    line with escapes is its own key, since its separators may be escaped, so
+    lines of the same series only share a key if they have no escapes.
+    """
+    if "\\" in line:
+        return line
+    return line[: line.find("=", line.find(" "))]
+
+
+def parse_line(line: str):
+    """Parse a single field line of line protocol.
+
+    Returns:
+        (tuple[str, Tags, str, int, Any]): The measurement, tags, field, time
+        and value of the line.
+    """
+    key, fields, timestamp = _split_unescaped(line, " ", 2)
+    series = _split_unescaped(key, ",")
+    tags = tuple(
+        sorted(
+            (_unescape(k), _unescape(v))
+            for k, v in (_split_unescaped(tag, "=", 1) for tag in series[1:])
+        )
+    )
+    field, value = _split_unescaped(fields, "=", 1)
+    return (
+        _unescape(series[0]),
+        tags,
+        _unescape(field),
+        int(timestamp),
+        _field_value(value),
+    )
@@ -0,0 +1,167 @@
+"""Module providing per source bandwidth and query rate limits.
+
+Some sources run on small machines that also run the cryostat control
+software, so syncs from a source can be capped to a maximum transfer rate and
+a maximum number of concurrent queries. Limits are configured per source in
+sources.yaml:
+
+    limits:
+      max-bytes-per-second: 500000
+      max-concurrent-queries: 1
+
+Syncs have a priority. Backfills, such as re-syncs of divergent windows,
+yield to live incremental syncs of the same source: they wait for a query slot
+while a live sync is waiting, and pause between batches while a live sync is
+running.
+
+Governors are in-memory objects, so limits and priorities only apply within
+one process. `--verify`, `--restore` and `--rebalance` run in their own
+process and never overlap live syncs of that process. They are capped by the
+limits of the source on their own, and neither yield to nor share the caps of
+a daemon syncing the same source at the same time.
+"""
+
+import contextlib
+import threading
+import time
+from typing import Any
+
+import pydantic
+
+LIVE = "live"
+BACKFILL = "backfill"
+
+
+class Limits(pydantic.BaseModel):
+    """Model representing the limits of a source. None means unlimited."""
+
+    max_bytes_per_second: float | None = None
+    max_concurrent_queries: int | None = None
+
+
+def validate_limits(value: Any):
+    """Validate the 'limits' object of a source configuration object."""
+    if not isinstance(value, dict):
+        raise RuntimeError(
+            f"'limits' of a source must be a dict, not {type(value)}"  # type: ignore
+        )
+
+    rate = value.get("max-bytes-per-second")  # type: ignore
+    queries = value.get("max-concurrent-queries")  # type: ignore
+
+    for key in value:  # type: ignore
+        if key not in ("max-bytes-per-second", "max-concurrent-queries"):
+            raise RuntimeError(f"Unknown limit '{key}'.")
+
+    if rate is not None and (
+        not isinstance(rate, (int, float)) or isinstance(rate, bool) or rate <= 0
+    ):
+        raise RuntimeError("'max-bytes-per-second' must be a positive number.")
+    if queries is not None and (
+        not isinstance(queries, int) or isinstance(queries, bool) or queries <= 0
+    ):
+        raise RuntimeError("'max-concurrent-queries' must be a positive integer.")
+
+    return Limits(max_bytes_per_second=rate, max_concurrent_queries=queries)
+
+
+class Governor:
+    """Token bucket and query slots shared by every sync of one source."""
+
+    def __init__(self, limits: Limits):
+        self.limits = limits
+        self._cond = threading.Condition()
+        self._tokens = limits.max_bytes_per_second or 0.0
+        self._last = time.monotonic()
+        self._running = 0
+        self._live_running = 0
+        self._live_waiting = 0
+
+    @contextlib.contextmanager
+    def query(self, priority: str = LIVE):
+        """Hold a query slot of the source for the duration of the context."""
+        live = priority == LIVE
+        limit = self.limits.max_concurrent_queries
+        with self._cond:
+            if live:
+                self._live_waiting += 1
+            try:
+                while (limit is not None and self._running >= limit) or (
+                    not live and self._live_waiting
+                ):
+                    self._cond.wait()
+            finally:
+                if live:
+                    self._live_waiting -= 1
+            self._running += 1
+            if live:
+                self._live_running += 1
+                # Backfills waiting on this live sync may use any free slot.
+                self._cond.notify_all()
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= 1
+                if live:
+                    self._live_running -= 1
+                self._cond.notify_all()
+
+    def consume(self, nbytes: int, priority: str = LIVE):
+        """Account for `nbytes` transferred, sleeping to keep within the rate.
+
+        Backfills additionally wait until no live sync of the source is running.
+        """
+        if priority != LIVE:
+            with self._cond:
+                # Waiting on live syncs that are themselves waiting for a query
+                # slot could deadlock, so only running ones are yielded to.
+                while self._live_running:
+                    self._cond.wait()
+
+        delay = self.reserve(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self, nbytes: int):
+        """Account for `nbytes` transferred without sleeping.
+
+        Returns:
+            (float): The number of seconds the caller should pause to keep
+            within the rate.
+        """
+        rate = self.limits.max_bytes_per_second
+        if rate is None:
+            return 0.0
+
+        with self._cond:
+            now = time.monotonic()
+            # Allow bursts of up to one second of transfer.
+            self._tokens = min(rate, self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= nbytes
+            debt = -self._tokens
+
+        return max(0.0, debt / rate)
+
+
+_governors: dict[tuple[str, float | None, int | None], Governor] = {}
+_governors_lock = threading.Lock()
+
+
+def for_source(name: str, limits: Limits):
+    """Return the governor of a source with the given limits, creating it if needed.
+
+    Governors are keyed by their limits as well as the source, and never
+    replaced. Syncs running when the limits of a source change keep the
+    governor they started with, and copies read under the name of a source
+    with other limits, such as restores from its backup, get their own.
+    """
+    key = (name, limits.max_bytes_per_second, limits.max_concurrent_queries)
+    with _governors_lock:
+        gov = _governors.get(key)
+        if gov is None:
+            gov = Governor(limits)
+            _governors[key] = gov
+        return gov
@@ -0,0 +1,245 @@
+"""Module providing an in-memory cache of the latest value of every series.
+
+Dashboards mostly ask for the current value of every sensor, and answering
+that with `last()` scans on the central database is expensive. Every batch a
+sync reads passes through `observe`, which keeps the newest sample of each
+(source, measurement, tags, field) series in memory. The cache is served as
+json over http when LATEST_PORT is set:
+
+    GET /latest?source=mxp&measurement=thermometer&field=temperature
+
+Every query parameter other than `source`, `measurement` and `field` selects
+a tag value. The schema catalog of a source, see `catalog`, is served too:
+
+    GET /catalog?source=mxp&measurement=thermometer
+
+Setting LATEST_SNAPSHOT to a file path saves the cache there
+after every sync cycle and loads it on start, so a restart serves warm values.
+"""
+
+import json
+import os
+import threading
+import urllib.parse
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+import influxdb_client.client.flux_table
+
+import catalog
+import destinations
+import flux
+
+# (tags, field) -> (time in nanoseconds, value)
+_Series = dict[tuple[flux.Tags, str], tuple[int, Any]]
+
+
+def _latest_records(
+    records: list[influxdb_client.client.flux_table.FluxRecord],
+):
+    """Yield the last sample of every series in a batch of records.
+
+    Every flux table holds a single series in time order, so only the last
+    record of each table is converted.
+    """
+    seen: set[int] = set()
+    for r in reversed(records):
+        if r.table in seen or r.get_value() is None:
+            continue
+        seen.add(r.table)
+        yield (
+            r.get_measurement(),
+            flux.record_tags(r),
+            r.get_field(),
+            flux.time_ns(r.get_time()),
+            r.get_value(),
+        )
+
+
+def _latest_lines(texts: Iterable[str]):
+    """Yield the last sample of every series in line protocol texts.
+
+    Lines of a series are in time order, so only the last line of each
+    series key is parsed.
+    """
+    seen: set[str] = set()
+    for text in texts:
+        for line in reversed(text.split("\n")):
+            if not line:
+                continue
+            # Lines with escapes all get their own key, but the cache keeps
+            # the newest sample anyway.
+            key = flux.series_key(line)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield flux.parse_line(line)
+
+
+class LatestCache:
+    """The latest sample of every series, keyed by source and measurement."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sources: dict[str, dict[str, _Series]] = {}
+
+    def _put(
+        self,
+        source: str,
+        measurement: str,
+        tags: flux.Tags,
+        field: str,
+        t: int,
+        value: Any,
+    ):
+        series = self._sources.setdefault(source, {}).setdefault(measurement, {})
+        current = series.get((tags, field))
+        # Re-synced windows must not replace newer values.
+        if current is None or current[0] <= t:
+            series[(tags, field)] = (t, value)
+
+    def update(self, source: str, batch: destinations.Batch):
+        """Record the samples of a batch read from `source`."""
+        if batch.records:
+            samples = list(_latest_records(batch.records))
+        else:
+            samples = list(_latest_lines(batch.lines))
+
+        with self._lock:
+            for measurement, tags, field, t, value in samples:
+                self._put(source, measurement, tags, field, t, value)
+
+    def query(
+        self,
+        source: str | None = None,
+        measurement: str | None = None,
+        field: str | None = None,
+        tags: dict[str, str] | None = None,
+    ):
+        """Return the latest sample of every series matching the arguments.
+
+        Returns:
+            (list[dict[str, Any]]): One dict per series, with its source,
+            measurement, tags, field, time in nanoseconds and value.
+        """
+        with self._lock:
+            sources = (
+                self._sources.items()
+                if source is None
+                else [(source, self._sources.get(source, {}))]
+            )
+            result: list[dict[str, Any]] = []
+            for source_name, measurements in sources:
+                selected = (
+                    measurements.items()
+                    if measurement is None
+                    else [(measurement, measurements.get(measurement, {}))]
+                )
+                for measurement_name, series in selected:
+                    for (series_tags, series_field), (t, value) in series.items():
+                        if field is not None and series_field != field:
+                            continue
+                        if tags and any(
+                            dict(series_tags).get(k) != v for k, v in tags.items()
+                        ):
+                            continue
+                        result.append(
+                            {
+                                "source": source_name,
+                                "measurement": measurement_name,
+                                "tags": dict(series_tags),
+                                "field": series_field,
+                                "time": t,
+                                "value": value,
+                            }
+                        )
+            return result
+
+    def save(self, path: str):
+        """Write a snapshot of the cache to `path`."""
+        entries = self.query()
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp, path)
+
+    def load(self, path: str):
+        """Load a snapshot written by `save`, if it exists."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries: list[dict[str, Any]] = json.load(f)
+        except FileNotFoundError:
+            return
+
+        with self._lock:
+            for e in entries:
+                self._put(
+                    e["source"],
+                    e["measurement"],
+                    tuple(sorted(e["tags"].items())),
+                    e["field"],
+                    e["time"],
+                    e["value"],
+                )
+
+
+CACHE = LatestCache()
+
+
+def observe(
+    source: str, batches: Iterable[destinations.Batch]
+) -> Iterator[destinations.Batch]:
+    """Record every batch read from `source` in the cache as it passes through."""
+    for batch in batches:
+        CACHE.update(source, batch)
+        yield batch
+
+
+def serve(port: int):
+    """Serve the cache and the catalog over http on `port` from a background thread."""
+    # Imported here so the http server is only loaded when it is enabled.
+    import http.server  # pylint: disable=import-outside-toplevel
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """Serves cache and catalog queries."""
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Serve a cache or catalog query."""
+            url = urllib.parse.urlsplit(self.path)
+            path = url.path.rstrip("/")
+            params = dict(urllib.parse.parse_qsl(url.query))
+
+            if path == "/latest":
+                result = CACHE.query(
+                    source=params.pop("source", None),
+                    measurement=params.pop("measurement", None),
+                    field=params.pop("field", None),
+                    tags=params,
+                )
+            elif path == "/catalog":
+                if "source" not in params:
+                    self.send_error(400, "Missing 'source' parameter")
+                    return
+                result = catalog.CATALOG.describe(
+                    params["source"], params.get("measurement")
+                )
+            else:
+                self.send_error(404)
+                return
+
+            body = json.dumps(result).encode()
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any):  # pylint: disable=W0622
+            pass
+
+    server = http.server.ThreadingHTTPServer(("", port), Handler)
+    threading.Thread(
+        target=server.serve_forever, name="latest-http", daemon=True
+    ).start()
+    return server
@@ -0,0 +1,105 @@
+"""Module coordinating several centraldb workers through the tracking database.
+
+With a tracking database shared by several workers, each worker only syncs
+the sources it holds a lease on. Every cycle a worker claims up to its fair
+share of the configured sources, the number of sources divided by the number
+of live workers, and releases leases beyond that share so a newly started
+worker picks them up. A background thread renews the worker's heartbeat and
+leases every third of `LEASE_TTL`, also while the worker sleeps between
+cycles. If a worker dies its leases expire, and the remaining workers take
+its sources over on their next cycle.
+
+A single worker simply claims every source.
+"""
+
+import hashlib
+import math
+import threading
+
+import db
+import env
+
+
+class Coordinator:
+    """Claims and renews the source leases of this worker."""
+
+    def __init__(self, owner: str = env.WORKER_ID, ttl: float = env.LEASE_TTL):
+        self.owner = owner
+        self.ttl = ttl
+        self.held: set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        """Register the worker and start renewing its heartbeat and leases."""
+        db.heartbeat_worker(self.owner, self.ttl)
+        self._thread = threading.Thread(
+            target=self._heartbeat, name="lease-heartbeat", daemon=True
+        )
+        self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                db.heartbeat_worker(self.owner, self.ttl)
+                with self._lock:
+                    held = set(self.held)
+                kept = db.renew_leases(held, self.owner, self.ttl)
+                with self._lock:
+                    lost = self.held & (held - kept)
+                    self.held -= lost
+                for name in sorted(lost):
+                    print(f"Lost the lease of '{name}' to another worker.")
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # The tracking database may be briefly unreachable; leases
+                # stay valid until they expire.
+                print("FAILED TO RENEW LEASES do to error: ", e)
+
+    def _claim_order(self, names: list[str]):
+        # Every worker tries the unowned sources in a different order, so
+        # workers starting together do not race for the same leases.
+        return sorted(
+            names,
+            key=lambda name: hashlib.md5(f"{self.owner}/{name}".encode()).digest(),
+        )
+
+    def assign(self, names: list[str]):
+        """Claim this worker's share of `names` and release the rest.
+
+        Returns:
+            (list[str]): The names this worker should sync this cycle, in the
+            order given.
+        """
+        db.heartbeat_worker(self.owner, self.ttl)
+        workers = db.get_live_workers()
+        share = math.ceil(len(names) / max(1, len(workers)))
+        owners = db.get_lease_owners()
+
+        mine = [name for name in names if owners.get(name) == self.owner]
+        for name in mine[share:]:
+            db.release_lease(name, self.owner)
+        mine = [
+            name for name in mine[:share] if db.claim_lease(name, self.owner, self.ttl)
+        ]
+
+        for name in self._claim_order(names):
+            if len(mine) >= share:
+                break
+            if name in owners:
+                continue
+            if db.claim_lease(name, self.owner, self.ttl):
+                mine.append(name)
+
+        with self._lock:
+            self.held = set(mine)
+        return [name for name in names if name in self.held]
+
+    def stop(self):
+        """Stop renewing, and hand every lease back to the other workers."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            self.held = set()
+        db.remove_worker(self.owner)
@@ -1,212 +1,180 @@
 """Main module for the maybell central fridge database.
 
 Pulls and backs up data from influxdb databases listed in the sources.yaml file.
+
+Only the standard library is imported until the command line is parsed; the
+sync machinery in `sync`, with influxdb_client, pydantic, sqlalchemy and
+yaml, is imported once it is needed. Exits with status 0 if every selected
+source was handled, 1 if any failed, and 2 on usage or configuration errors.
 """
 
+import argparse
 import os
+import sys
 import time
 
-import influxdb_client
-import influxdb_client.client.flux_table
-import influxdb_client.client.write_api
-import pydantic
-import urllib3.exceptions
-import yaml
-
-import db
 import env
 
-YamlType = int | float | bool | str | list["YamlType"] | dict[str, "YamlType"] | None
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_CONFIG = 2
 
 
-class _DB(pydantic.BaseModel):
-    """Model representing a configured database source."""
+def _parse_args(argv: list[str] | None):
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--config",
+        default="sources.yaml",
+        help="Path of the sources configuration file.",
+    )
+    parser.add_argument(
+        "--source",
+        dest="sources",
+        action="append",
+        metavar="NAME",
+        help="Only handle this source. May be given several times.",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Run a single sync cycle and exit, for cron jobs and orchestrators.",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Verify the backups window by window and re-sync divergent windows.",
+    )
+    parser.add_argument(
+        "--verify-window",
+        type=int,
+        default=3600,
+        help="Size of the verified windows in seconds.",
+    )
+    parser.add_argument(
+        "--verify-start",
+        type=float,
+        default=0.0,
+        help="Timestamp to start verifying from.",
+    )
+    parser.add_argument(
+        "--verify-checksum",
+        default="count",
+        help="Aggregate compared per window and measurement: count or sum.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Estimate the next sync of every source and print its plan, "
+        + "without syncing.",
+    )
+    parser.add_argument(
+        "--rebalance",
+        action="store_true",
+        help="Move buckets of sharded destinations to the nodes assigned by "
+        + "the hash ring, for example after adding a node.",
+    )
+    parser.add_argument(
+        "--restore",
+        action="store_true",
+        help="Write a range of the selected sources back from their backups, "
+        + "for example after a source lost its disk. Resumes interrupted restores.",
+    )
+    parser.add_argument(
+        "--restore-start",
+        type=float,
+        default=0.0,
+        help="Timestamp to start restoring from.",
+    )
+    parser.add_argument(
+        "--restore-stop",
+        type=float,
+        default=None,
+        help="Timestamp to restore up to. Defaults to now.",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Sync all sources concurrently in an asyncio event loop.",
+    )
+    args = parser.parse_args(argv)
+    if args.restore and not args.sources:
+        parser.error("--restore needs the sources to restore, given with --source")
+    return args
 
-    name: str
-    url: str
-    token: str
-    org: str
-    bucket: str
 
+def main(argv: list[str] | None = None):
+    """Pull and backup data from configured databases."""
 
-def _validate_sources(sources: YamlType):
-    if not isinstance(sources, dict):
-        raise RuntimeError(
-            "Source file has an invalid structure. The root item was "
-            + f"expected to be a dict, but was instead a {type(sources)}"
-        )
+    args = _parse_args(argv)
 
-    if "sources" not in sources:
-        raise RuntimeError(
-            "Source file must have a list of sources under the key 'sources'."
-        )
+    # pylint: disable=import-outside-toplevel
+    import coalescer
+    import db
+    import latest
+    import leases
+    import sync
 
-    source_list = sources["sources"]
+    def load():
+        try:
+            return sync.load_config(args.config, args.sources)
+        except (OSError, RuntimeError) as e:
+            print("CONFIG ERROR:", e)
+            return None
 
-    if not isinstance(source_list, list):
-        raise RuntimeError(
-            "sources structure in the Source file must be a list of "
-            + f"db configuration objects, not {type(sources['sources'])}"
-        )
+    loaded = load()
+    if loaded is None:
+        return EXIT_CONFIG
+    config, dbs = loaded
 
-    dbs: list[_DB] = []
+    os.makedirs(env.DBDIR, exist_ok=True)
 
-    for source in source_list:
-        if not isinstance(source, dict):
-            raise RuntimeError(
-                "Each source must be an db configuration object "
-                + "containing a 'name' and 'url' object."
-            )
+    db.init_engine()
 
-        name = source.get("name")
-        url = source.get("url")
-        token = source.get("token")
-        org = source.get("org")
-        bucket = source.get("bucket")
+    if env.LATEST_SNAPSHOT is not None:
+        latest.CACHE.load(env.LATEST_SNAPSHOT)
 
-        if not isinstance(name, str):
-            raise RuntimeError(
-                "Db configuration object must contain a 'name' of type string"
-            )
-        if not isinstance(url, str):
-            raise RuntimeError(
-                "Db configuration object must contain a 'url' of type string"
-            )
-        if not isinstance(token, str):
-            raise RuntimeError(
-                "Db configuration object must contain a 'token' of type string"
-            )
-        if not isinstance(org, str):
-            raise RuntimeError(
-                "Db configuration object must contain a 'org' of type string"
-            )
-        if not isinstance(bucket, str):
-            raise RuntimeError(
-                "Db configuration object must contain a 'bucket' of type string"
+    if args.verify:
+        try:
+            failed = sync.verify_all(
+                dbs, args.verify_window, args.verify_start, args.verify_checksum
             )
+        except RuntimeError as e:
+            print("CONFIG ERROR:", e)
+            return EXIT_CONFIG
+        return EXIT_FAILED if failed else EXIT_OK
 
-        dbs.append(_DB(name=name, url=url, token=token, org=org, bucket=bucket))
-
-    return dbs
-
-
-def _record_to_point(record: influxdb_client.client.flux_table.FluxRecord):
-    """Convert a FluxRecord into a Point."""
-    point = influxdb_client.Point(record.get_measurement())
-
-    point.time(record.get_time())
-    point.field(record.get_field(), record.get_value())
+    if args.plan:
+        return EXIT_FAILED if sync.plan_all(dbs) else EXIT_OK
 
-    for key, value in record.values.items():
-        if key not in [
-            "_measurement",
-            "_field",
-            "_value",
-            "_time",
-            "result",
-            "table",
-            "_stop",
-            "_start",
-        ]:
-            point = point.tag(key, value)
+    if args.rebalance:
+        return EXIT_FAILED if sync.rebalance(dbs) else EXIT_OK
 
-    return point
-
-
-def _format_time(t: float):
-    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
-
-
-def _query_all(
-    query_api: influxdb_client.QueryApi,
-    bucket: str,
-    start_time: float,
-    end_time: float | None = None,
-):
-
-    start_str = f"start: {_format_time(start_time)}"
-    end_str = "" if end_time is None else f", stop: {_format_time(end_time)}"
-    query = f"""from(bucket: "{bucket}")
-                     |> range({start_str}{end_str})"""
-
-    return query_api.query_stream(query)
-
-
-def _ensure_bucket_exists(bucket: str, client: influxdb_client.InfluxDBClient):
-    """Ensure that the bucket `bucket` exists in `client`'s database.
-
-    If `bucket` is not found, it is created.
-
-    Returns:
-        (bool): True if the bucket was successfully created, False otherwise.
-    """
-    buckets_api = client.buckets_api()
-
-    # Give the db 5 seconds to boot, if it's not already running.
-    for _ in range(5):
+    if args.restore:
+        stop = time.time() if args.restore_stop is None else args.restore_stop
         try:
-            if buckets_api.find_bucket_by_name(bucket) is None:
-                buckets_api.create_bucket(bucket_name=bucket)
-            return True
-        except urllib3.exceptions.HTTPError:
-            time.sleep(1)
+            failed = sync.restore_all(dbs, args.restore_start, stop)
+        except RuntimeError as e:
+            print("CONFIG ERROR:", e)
+            return EXIT_CONFIG
+        return EXIT_FAILED if failed else EXIT_OK
 
-    return False
+    if env.LATEST_PORT is not None and not args.once:
+        latest.serve(env.LATEST_PORT)
 
+    coordinator = leases.Coordinator()
+    coordinator.start()
 
-def _sync_db(source: _DB, start_time: float, end_time: float | None = None):
-    """Pull and backup a target db."""
-    client = influxdb_client.InfluxDBClient(
-        url=source.url, token=source.token, org=source.org
-    )
-
-    query_api = client.query_api()
-
-    dest_bucket_name = source.name
-    dest_client = influxdb_client.InfluxDBClient(
-        url=env.LOCAL_IDB_URL, token="12345678=", org="maybell"
-    )
-
-    tables = _query_all(query_api, source.bucket, start_time, end_time)
-
-    _ensure_bucket_exists(dest_bucket_name, dest_client)
-
-    with dest_client.write_api(
-        write_options=influxdb_client.client.write_api.SYNCHRONOUS
-    ) as write_api:
-
-        all_points_consumed = False
-
-        while not all_points_consumed:
-            points: list[influxdb_client.Point] = []
-
-            # Consume 10000 points at a time.
-            for _ in range(10000):
-                try:
-                    points.append(_record_to_point(next(tables)))
-                except StopIteration:
-                    all_points_consumed = True
-                    break
-
-            if points:
-                for _ in range(5):
-                    try:
-                        write_api.write(bucket=dest_bucket_name, record=points)
-                    except Exception:
-
-
-def main():
-    """Pull and backup data from configured databases."""
-
-    os.makedirs(env.DBDIR, exist_ok=True)
-
-    db.init_engine()
+    try:
+        while True:
+            failed = sync.run_cycle(dbs, coordinator, args.use_async)
 
-    while True:
+            if args.once:
+                # Points queued for coalesced writes are already written, since
+                # every writer waits for its batches; this closes the clients.
+                coalescer.close()
+                return EXIT_FAILED if failed else EXIT_OK
 
-        with open("sources.yaml", encoding="utf-8") as f:
-            config: dict[str, YamlType] = yaml.safe_load(f.read())
-            dbs = _validate_sources(config)
             delay = config.get("sync-rate", 600)
             if not isinstance(delay, (float, int)):
                 print(
@@ -217,22 +185,18 @@ def main():
                 print("Defaulting to default sync-rate: ", 600)
                 delay = 600
 
-        for d in dbs:
-            t = db.get_sync_time(d.name)
-            try:
-                print(f"Syncing db '{d.name}...'")
-                _sync_db(d, t)
-                print("Updating sync state...")
-                db.update(d.name)
-                print(f"'{d.name}' finished syncing.")
-            except (IOError, urllib3.exceptions.NewConnectionError) as e:
-                print("FAILED TO SYNC DB:", d.name, " do to error: ", e)
+            print(f"Sync cycle finished. Will run again in {delay} seconds.")
+            time.sleep(delay)
 
-            print("\n")
+            # The configuration is reloaded every cycle, keeping the previous
+            # one if it became invalid.
+            loaded = load()
+            if loaded is not None:
+                config, dbs = loaded
 
-        print(f"Sync cycle finished. Will run again in {delay} seconds.")
-        time.sleep(delay)
+    finally:
+        coordinator.stop()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
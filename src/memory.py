@@ -0,0 +1,98 @@
+"""Module providing a global memory budget for in-flight sync data.
+
+Batches are sized by their estimated size in bytes rather than by a fixed
+number of records, and every batch holds its size against a process wide
+budget until every destination has written it. Readers block while the
+budget is exhausted, so peak memory is flat no matter how wide records are,
+or how many batches are queued for slow destinations.
+
+The budget is set in bytes with the MEMORY_BUDGET environment variable.
+Setting MEMORY_TRACE to a non-empty value additionally reports the
+tracemalloc high-water mark of every sync.
+"""
+
+import contextlib
+import threading
+import tracemalloc
+
+import env
+
+# Estimated bytes held by a parsed flux record, excluding its line protocol.
+_RECORD_OVERHEAD = 600
+
+# Estimated bytes held per byte of line protocol. Covers the line itself and
+# the tag and field strings of the record it was built from.
+_BYTES_PER_LINE_BYTE = 4
+
+# A batch is at most this fraction of the budget, so several batches can be
+# in flight at once.
+_BATCH_FRACTION = 8
+
+
+def estimate_record(line: str):
+    """Return the estimated bytes held by a record and its line protocol."""
+    return _RECORD_OVERHEAD + len(line) * _BYTES_PER_LINE_BYTE
+
+
+class Budget:
+    """Byte semaphore bounding the memory held by in-flight batches."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._available = capacity
+        self._cond = threading.Condition()
+
+    @property
+    def batch_bytes(self):
+        """Return the target size of a single batch."""
+        return max(1, self.capacity // _BATCH_FRACTION)
+
+    def acquire(self, nbytes: int, timeout: float | None = None):
+        """Block until `nbytes` of the budget are available, and take them.
+
+        Returns:
+            (int | None): The number of bytes taken, to be passed to
+            `release`, or None if `timeout` seconds passed first.
+        """
+        # A single oversized batch may use the whole budget, but no more.
+        nbytes = min(nbytes, self.capacity)
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self._available >= nbytes, timeout=timeout
+            ):
+                return None
+            self._available -= nbytes
+        return nbytes
+
+    def release(self, nbytes: int):
+        """Return bytes taken by `acquire` to the budget."""
+        with self._cond:
+            self._available += nbytes
+            self._cond.notify_all()
+
+
+BUDGET = Budget(env.MEMORY_BUDGET)
+
+
+@contextlib.contextmanager
+def trace_peak(name: str):
+    """Print the tracemalloc high-water mark of the context, if enabled."""
+    if not env.MEMORY_TRACE:
+        yield
+        return
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    try:
+        yield
+    finally:
+        peak = tracemalloc.get_traced_memory()[1] - base
+        if started:
+            tracemalloc.stop()
+        print(
+            f"'{name}' peak traced memory: {peak / 2**20:.1f} MiB "
+            + f"(budget {BUDGET.capacity / 2**20:.1f} MiB)"
+        )
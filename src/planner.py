@@ -0,0 +1,287 @@
+"""Module providing a planning step that sizes a sync before running it.
+
+A sync of 30 seconds of data and a backfill of two years are very different
+jobs. Before a long range is synced, cheap estimate queries are run against
+the source: a `count()` of points over coarse windows, and the first point of
+every series, which gives the series cardinality and a sample of line sizes.
+From the estimate the planner picks:
+
+- the partitions the range is split into, cut where the running count of
+  points reaches `_PARTITION_POINTS`, so dense periods get short partitions;
+- how many partitions are synced in parallel;
+- the batch size, so a small sync is written in a single batch;
+- whether raw responses are converted in the process pool, which only pays
+  off for large syncs.
+
+Ranges shorter than `_ESTIMATE_MIN_SPAN` are not estimated, and are synced in
+a single partition, converted in process, as before.
+"""
+
+import math
+import time
+from typing import NamedTuple
+
+import influxdb_client
+
+import filters
+import flux
+import governor
+import memory
+
+# Ranges shorter than this, in seconds, are synced without estimating them.
+_ESTIMATE_MIN_SPAN = 6 * 3600
+
+# Target number of coarse windows counted by the estimate.
+_ESTIMATE_WINDOWS = 500
+
+# Syncs with fewer points are converted in process, in a single partition.
+_SMALL_POINTS = 200_000
+
+# Target number of points per partition.
+_PARTITION_POINTS = 2_000_000
+
+# Maximum number of partitions synced in parallel, unless the source limits
+# its concurrent queries further.
+_MAX_PARALLELISM = 4
+
+# Number of sampled series used to estimate the size of a point.
+_SAMPLE_SERIES = 1000
+
+# Smallest batch chosen by the planner, in estimated bytes.
+_MIN_BATCH_BYTES = 2**16
+
+# Rough single core conversion throughput, in points per second, and fixed
+# cost of a partition's query and writer setup, in seconds. Only used for the
+# expected duration.
+_POINTS_PER_SECOND = 50_000
+_PARTITION_SETUP = 0.5
+
+
+class Plan(NamedTuple):
+    """How a sync of a range is run, and what it is expected to transfer.
+
+    The estimates are None if the range was not estimated.
+    """
+
+    partitions: list[tuple[float, float | None]]
+    parallelism: int
+    batch_bytes: int
+    use_processes: bool
+    points: int | None = None
+    series: int | None = None
+    bytes: int | None = None
+    seconds: float | None = None
+
+
+class _Estimate(NamedTuple):
+    points: int
+    series: int
+    line_bytes: float
+    record_bytes: float
+    windows: list[tuple[float, int]]
+
+
+def _format_time(t: float):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+
+def _range(start_time: float, stop_time: float, source_filter: filters.SourceFilter):
+    return (
+        f"|> range(start: {_format_time(start_time)}, "
+        + f"stop: {_format_time(stop_time)}){filters.to_flux(source_filter)}"
+    )
+
+
+def _count_query(
+    bucket: str,
+    start_time: float,
+    stop_time: float,
+    window: int,
+    source_filter: filters.SourceFilter,
+):
+    """Return a flux query counting the points of a bucket per window."""
+    return f"""from(bucket: "{bucket}")
+            {_range(start_time, stop_time, source_filter)}
+            |> aggregateWindow(every: {window}s, fn: count, createEmpty: false, timeSrc: "_start")
+            |> group(columns: ["_time"])
+            |> sum()
+            |> group()"""
+
+
+def _sample_query(
+    bucket: str,
+    start_time: float,
+    stop_time: float,
+    source_filter: filters.SourceFilter,
+):
+    """Return a flux query selecting the first point of every series."""
+    return f"""from(bucket: "{bucket}")
+            {_range(start_time, stop_time, source_filter)}
+            |> first()"""
+
+
+def _estimate(
+    query_api: influxdb_client.QueryApi,
+    bucket: str,
+    start_time: float,
+    stop_time: float,
+    source_filter: filters.SourceFilter,
+):
+    window = max(3600, math.ceil((stop_time - start_time) / _ESTIMATE_WINDOWS))
+    window = math.ceil(window / 3600) * 3600
+
+    windows: list[tuple[float, int]] = []
+    for record in query_api.query_stream(
+        _count_query(bucket, start_time, stop_time, window, source_filter)
+    ):
+        windows.append((record.get_time().timestamp(), int(record.get_value())))
+    windows.sort()
+
+    series = 0
+    line_bytes = 0
+    record_bytes = 0
+    for record in query_api.query_stream(
+        _sample_query(bucket, start_time, stop_time, source_filter)
+    ):
+        series += 1
+        if series <= _SAMPLE_SERIES:
+            line = flux.record_to_point(record).to_line_protocol()
+            line_bytes += len(line) + 1
+            record_bytes += memory.estimate_record(line)
+
+    sampled = max(1, min(series, _SAMPLE_SERIES))
+    return _Estimate(
+        points=sum(count for _, count in windows),
+        series=series,
+        line_bytes=line_bytes / sampled,
+        record_bytes=record_bytes / sampled,
+        windows=windows,
+    )
+
+
+def _partitions(
+    windows: list[tuple[float, int]],
+    start_time: float,
+    stop_time: float | None,
+    partition_points: int,
+):
+    """Split a range where the running count of points reaches `partition_points`."""
+    partitions: list[tuple[float, float | None]] = []
+    partition_start = start_time
+    points = 0
+    for window_start, count in windows:
+        if points and points + count > partition_points:
+            # Windows are aligned to the epoch, so the first one may start
+            # before the range.
+            cut = max(window_start, partition_start)
+            if cut > partition_start:
+                partitions.append((partition_start, cut))
+                partition_start = cut
+                points = 0
+        points += count
+
+    partitions.append((partition_start, stop_time))
+    return partitions
+
+
+def plan(
+    query_api: influxdb_client.QueryApi,
+    bucket: str,
+    start_time: float,
+    stop_time: float | None = None,
+    source_filter: filters.SourceFilter | None = None,
+    limits: governor.Limits | None = None,
+    processes: int = 0,
+    ordered: bool = False,
+    always_estimate: bool = False,
+):
+    """Plan the sync of a range of a source bucket.
+
+    Args:
+        query_api (QueryApi): Query api of the source database.
+        bucket (str): The bucket in the source database.
+        start_time (float): The start of the range.
+        stop_time (float | None): The end of the range, or None for now.
+        source_filter (SourceFilter | None): The filter of the source.
+        limits (Limits | None): The limits of the source.
+        processes (int): The number of conversion processes available to the
+        sync, 0 if it must convert in process.
+        ordered (bool): Whether partitions must be synced one at a time, in
+        order. Archive destinations ignore samples older than the last one
+        archived.
+        always_estimate (bool): Estimate the range even if it is short.
+
+    Returns:
+        (Plan): The plan.
+    """
+    if source_filter is None:
+        source_filter = filters.SourceFilter()
+    if limits is None:
+        limits = governor.Limits()
+
+    now = time.time()
+    span_stop = now if stop_time is None else stop_time
+
+    if not always_estimate and span_stop - start_time < _ESTIMATE_MIN_SPAN:
+        return Plan(
+            partitions=[(start_time, stop_time)],
+            parallelism=1,
+            batch_bytes=memory.BUDGET.batch_bytes,
+            use_processes=False,
+        )
+
+    est = _estimate(query_api, bucket, start_time, span_stop, source_filter)
+
+    if est.points < _SMALL_POINTS:
+        partitions = [(start_time, stop_time)]
+        use_processes = False
+    else:
+        partitions = _partitions(est.windows, start_time, stop_time, _PARTITION_POINTS)
+        use_processes = processes > 0
+
+    parallelism = min(len(partitions), _MAX_PARALLELISM)
+    if limits.max_concurrent_queries is not None:
+        parallelism = min(parallelism, limits.max_concurrent_queries)
+    if ordered:
+        parallelism = 1
+
+    partition_bytes = est.record_bytes * est.points / len(partitions)
+    batch_bytes = int(
+        min(memory.BUDGET.batch_bytes, max(_MIN_BATCH_BYTES, partition_bytes))
+    )
+
+    total_bytes = int(est.line_bytes * est.points)
+    workers = processes if use_processes else 1
+    seconds = est.points / (_POINTS_PER_SECOND * workers) + _PARTITION_SETUP * len(
+        partitions
+    ) / max(1, parallelism)
+    if limits.max_bytes_per_second is not None:
+        seconds = max(seconds, total_bytes / limits.max_bytes_per_second)
+
+    return Plan(
+        partitions=partitions,
+        parallelism=max(1, parallelism),
+        batch_bytes=batch_bytes,
+        use_processes=use_processes,
+        points=est.points,
+        series=est.series,
+        bytes=total_bytes,
+        seconds=seconds,
+    )
+
+
+def describe(p: Plan):
+    """Return a human readable summary of a plan."""
+    parts: list[str] = []
+    if p.points is not None:
+        parts.append(
+            f"~{p.points} points in {p.series} series, "
+            + f"~{(p.bytes or 0) / 2**20:.1f} MiB, ~{p.seconds or 0:.0f}s"
+        )
+    parts.append(
+        f"{len(p.partitions)} partitions x {p.parallelism} parallel, "
+        + f"{p.batch_bytes / 2**20:.1f} MiB batches, "
+        + ("process" if p.use_processes else "in process")
+        + " conversion"
+    )
+    return "; ".join(parts)
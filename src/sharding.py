@@ -0,0 +1,91 @@
+"""Module providing consistent-hash placement of buckets on influxdb nodes.
+
+A sharded destination spreads the buckets of its sources over several local
+influxdb nodes, so central ingest grows with the number of nodes. Every node
+owns `_VNODES` points on a hash ring, and a bucket is stored on the first
+`replicas` distinct nodes found walking the ring from the hash of its name.
+Adding a node only moves the buckets whose ring position it takes over.
+
+The nodes a bucket was first written to are recorded in the tracking
+database, and the bucket keeps being written there even after nodes are
+added, so data is never silently split between nodes. Buckets are only moved
+to the nodes the ring currently assigns them by an explicit rebalance. A
+bucket that is routed for the first time after its destination already
+synced, because the destination became sharded or lost all of its nodes, is
+synced to its new nodes from the start.
+"""
+
+import bisect
+import hashlib
+
+import db
+
+# Points every node owns on the ring.
+_VNODES = 128
+
+
+def _hash(key: str):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class Ring:
+    """Consistent-hash ring over a set of node names."""
+
+    def __init__(self, nodes: list[str], vnodes: int = _VNODES):
+        points = sorted(
+            (_hash(f"{node}#{i}"), node) for node in set(nodes) for i in range(vnodes)
+        )
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+        self.size = len(set(nodes))
+
+    def nodes_for(self, key: str, replicas: int = 1):
+        """Return the `replicas` distinct nodes that `key` is assigned to."""
+        replicas = min(replicas, self.size)
+        nodes: list[str] = []
+        i = bisect.bisect(self._hashes, _hash(key))
+        while len(nodes) < replicas:
+            node = self._nodes[i % len(self._nodes)]
+            if node not in nodes:
+                nodes.append(node)
+            i += 1
+        return sorted(nodes)
+
+
+def is_routed(destination: str, bucket: str, nodes: list[str]):
+    """Return whether a bucket has a recorded route to any of `nodes`."""
+    return any(node in nodes for node in db.get_routes(destination, bucket))
+
+
+def route(destination: str, bucket: str, nodes: list[str], replicas: int = 1):
+    """Return the nodes a bucket of a sharded destination is written to.
+
+    Recorded routes are kept. A bucket without a route, or whose recorded
+    nodes are all gone from the configuration, is assigned by the ring and
+    the assignment is recorded.
+    """
+    recorded = [node for node in db.get_routes(destination, bucket) if node in nodes]
+    if recorded:
+        return recorded
+
+    assigned = Ring(nodes).nodes_for(bucket, replicas)
+    db.set_routes(destination, bucket, assigned)
+    return assigned
+
+
+def moves(destination: str, buckets: list[str], nodes: list[str], replicas: int = 1):
+    """Return the buckets whose recorded nodes differ from their ring assignment.
+
+    Returns:
+        (list[tuple[str, list[str], list[str]]]): The (bucket, recorded nodes,
+        assigned nodes) of every bucket that should move. Buckets that were
+        never routed are not included.
+    """
+    ring = Ring(nodes)
+    result: list[tuple[str, list[str], list[str]]] = []
+    for bucket in buckets:
+        recorded = db.get_routes(destination, bucket)
+        assigned = ring.nodes_for(bucket, replicas)
+        if recorded and recorded != assigned:
+            result.append((bucket, recorded, assigned))
+    return result
@@ -0,0 +1,987 @@
+"""Module providing the sync machinery behind the command line in `main`.
+
+Loads the sources configured in sources.yaml, and pulls and backs up each of
+them to its destinations. Modules only some modes need, such as the asyncio
+runtime, process conversion, verification, sharding and the archive, are
+imported when first used.
+"""
+
+import concurrent.futures
+import functools
+import time
+from collections.abc import Iterator
+
+import influxdb_client
+import influxdb_client.client.flux_table
+import pydantic
+import urllib3.exceptions
+import yaml
+
+import breaker
+import catalog
+import db
+import destinations
+import env
+import filters
+import flux
+import governor
+import latest
+import leases
+import memory
+import planner
+
+YamlType = int | float | bool | str | list["YamlType"] | dict[str, "YamlType"] | None
+
+
+class _DB(pydantic.BaseModel):
+    """Model representing a configured database source."""
+
+    name: str
+    url: str
+    token: str
+    org: str
+    bucket: str
+    destinations: list[destinations.Destination]
+    filter: filters.SourceFilter = filters.SourceFilter()
+    limits: governor.Limits = governor.Limits()
+
+
+def _validate_sources(sources: YamlType):
+    if not isinstance(sources, dict):
+        raise RuntimeError(
+            "Source file has an invalid structure. The root item was "
+            + f"expected to be a dict, but was instead a {type(sources)}"
+        )
+
+    if "sources" not in sources:
+        raise RuntimeError(
+            "Source file must have a list of sources under the key 'sources'."
+        )
+
+    source_list = sources["sources"]
+
+    if not isinstance(source_list, list):
+        raise RuntimeError(
+            "sources structure in the Source file must be a list of "
+            + f"db configuration objects, not {type(sources['sources'])}"
+        )
+
+    nodes: list[destinations.InfluxNode] | None = None
+    replicas = 1
+    if "local-nodes" in sources:
+        nodes = destinations.validate_nodes(sources["local-nodes"])
+        replicas = destinations.validate_replicas(sources.get("replicas", 1), nodes)
+
+    dbs: list[_DB] = []
+
+    for source in source_list:
+        if not isinstance(source, dict):
+            raise RuntimeError(
+                "Each source must be an db configuration object "
+                + "containing a 'name' and 'url' object."
+            )
+
+        name = source.get("name")
+        url = source.get("url")
+        token = source.get("token")
+        org = source.get("org")
+        bucket = source.get("bucket")
+
+        if not isinstance(name, str):
+            raise RuntimeError(
+                "Db configuration object must contain a 'name' of type string"
+            )
+        if not isinstance(url, str):
+            raise RuntimeError(
+                "Db configuration object must contain a 'url' of type string"
+            )
+        if not isinstance(token, str):
+            raise RuntimeError(
+                "Db configuration object must contain a 'token' of type string"
+            )
+        if not isinstance(org, str):
+            raise RuntimeError(
+                "Db configuration object must contain a 'org' of type string"
+            )
+        if not isinstance(bucket, str):
+            raise RuntimeError(
+                "Db configuration object must contain a 'bucket' of type string"
+            )
+
+        if "destinations" in source:
+            dests = destinations.validate_destinations(source["destinations"])
+        else:
+            dests = destinations.default_destinations(nodes, replicas)
+
+        if "filter" in source:
+            source_filter = filters.validate_filter(source["filter"])
+        else:
+            source_filter = filters.SourceFilter()
+
+        if "limits" in source:
+            limits = governor.validate_limits(source["limits"])
+        else:
+            limits = governor.Limits()
+
+        dbs.append(
+            _DB(
+                name=name,
+                url=url,
+                token=token,
+                org=org,
+                bucket=bucket,
+                destinations=dests,
+                filter=source_filter,
+                limits=limits,
+            )
+        )
+
+    return dbs
+
+
+def _format_time(t: float):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+
+def _build_query(
+    bucket: str,
+    start_time: float,
+    end_time: float | None = None,
+    source_filter: filters.SourceFilter | None = None,
+):
+    start_str = f"start: {_format_time(start_time)}"
+    end_str = "" if end_time is None else f", stop: {_format_time(end_time)}"
+    filter_str = "" if source_filter is None else filters.to_flux(source_filter)
+    return f"""from(bucket: "{bucket}")
+                     |> range({start_str}{end_str}){filter_str}"""
+
+
+def _query_all(
+    query_api: influxdb_client.QueryApi,
+    bucket: str,
+    start_time: float,
+    end_time: float | None = None,
+    source_filter: filters.SourceFilter | None = None,
+):
+
+    query = _build_query(bucket, start_time, end_time, source_filter)
+
+    return query_api.query_stream(query)
+
+
+def _verify_db(
+    source: _DB,
+    dest: destinations.InfluxDestination | destinations.ShardedDestination,
+    start_time: float,
+    window: int,
+    checksum: str,
+):
+    """Verify a backup of a source, and re-sync any window that differs.
+
+    A sharded destination is verified on every node its bucket is routed to.
+    If any divergent window could not be re-synced, IOError is raised once
+    the whole range has been checked.
+    """
+    import verify  # pylint: disable=import-outside-toplevel
+
+    client = influxdb_client.InfluxDBClient(
+        url=source.url, token=source.token, org=source.org
+    )
+    name = destinations.tracking_name(source.name, dest)
+
+    # Only windows that have been fully synced can be compared.
+    stop_time = db.get_sync_time(name)
+
+    divergent: list[tuple[float, float]] = []
+    # The reason every window that could not be re-synced failed, per target.
+    errors: dict[tuple[str, float, float], Exception] = {}
+    for target in destinations.influx_targets(dest, source.name):
+        dest_client = influxdb_client.InfluxDBClient(
+            url=target.url, token=target.token, org=target.org
+        )
+
+        def resync(
+            start: float, stop: float, target: destinations.InfluxDestination = target
+        ):
+            error = _sync_db(source, start, stop, [target], governor.BACKFILL)[
+                target.name
+            ]
+            if error is not None:
+                errors[(target.name, start, stop)] = error
+
+        for start, stop in verify.verify(
+            # Every node of a sharded destination is verified separately.
+            destinations.tracking_name(source.name, target),
+            client.query_api(),
+            source.bucket,
+            dest_client.query_api(),
+            target.bucket,  # type: ignore
+            start_time,
+            stop_time,
+            window=window,
+            checksum=checksum,
+            source_filter=filters.to_flux(source.filter),
+            resync=resync,
+        ):
+            span = f"{_format_time(start)} - {_format_time(stop)} in '{target.name}'"
+            error = errors.get((target.name, start, stop))
+            if error is None:
+                print(f"Re-synced divergent window {span}")
+            else:
+                print(f"FAILED TO RE-SYNC divergent window {span} do to error: ", error)
+            divergent.append((start, stop))
+
+    if errors:
+        raise IOError(f"{len(errors)} divergent windows could not be re-synced")
+    return divergent
+
+
+def _read_batches(
+    tables: Iterator[influxdb_client.client.flux_table.FluxRecord],
+    gov: governor.Governor,
+    priority: str,
+    target_bytes: int,
+):
+    """Read records in batches, converting each batch to line protocol once.
+
+    Batches are sized by their estimated memory, see `memory`, up to
+    `target_bytes` each.
+
+    Reading is paced by the source's governor, estimating the transferred
+    bytes from the size of the converted records.
+    """
+    all_points_consumed = False
+
+    while not all_points_consumed:
+        records: list[influxdb_client.client.flux_table.FluxRecord] = []
+        lines: list[str] = []
+        batch_bytes = 0
+        pending_bytes = 0
+
+        # Consume records until the batch reaches its share of the memory budget.
+        while batch_bytes < target_bytes:
+            try:
+                record = next(tables)
+            except StopIteration:
+                all_points_consumed = True
+                break
+
+            records.append(record)
+            line = flux.record_to_point(record).to_line_protocol()
+            if line:
+                lines.append(line)
+                pending_bytes += len(line) + 1
+            batch_bytes += memory.estimate_record(line)
+
+            if len(records) % 1000 == 0:
+                gov.consume(pending_bytes, priority)
+                pending_bytes = 0
+
+        gov.consume(pending_bytes, priority)
+
+        if records:
+            yield destinations.Batch(records, lines, batch_bytes)
+
+
+def _read_raw_batches(
+    query_api: influxdb_client.QueryApi,
+    query: str,
+    gov: governor.Governor,
+    priority: str,
+    target_bytes: int,
+):
+    """Read a raw response in batches, converting it in the process pool.
+
+    Batches carry no records, only line protocol.
+    """
+    import convert  # pylint: disable=import-outside-toplevel
+
+    response = query_api.query_raw(query)
+    # Several chunks are in flight per worker, so keep them well within a batch.
+    chunk_bytes = min(max(target_bytes // 8, 2**16), 2**22)
+
+    try:
+        texts: list[str] = []
+        batch_bytes = 0
+        for text, raw in convert.convert_stream(response.stream(2**16), chunk_bytes):
+            gov.consume(raw, priority)
+            if text:
+                texts.append(text)
+                batch_bytes += len(text) * 2
+            if batch_bytes >= target_bytes:
+                yield destinations.Batch([], texts, batch_bytes)
+                texts = []
+                batch_bytes = 0
+
+        if texts:
+            yield destinations.Batch([], texts, batch_bytes)
+    finally:
+        response.release_conn()
+
+
+def _plan_db(
+    source: _DB,
+    query_api: influxdb_client.QueryApi,
+    start_time: float,
+    end_time: float | None = None,
+    dests: list[destinations.Destination] | None = None,
+    always_estimate: bool = False,
+):
+    """Plan a sync of a source to some of its destinations, see `planner`."""
+    if dests is None:
+        dests = source.destinations
+
+    # Archive destinations need the parsed records, which process mode does
+    # not produce, and must receive the samples of a series in time order.
+    archived = any(isinstance(dest, destinations.ArchiveDestination) for dest in dests)
+
+    return planner.plan(
+        query_api,
+        source.bucket,
+        start_time,
+        end_time,
+        source.filter,
+        source.limits,
+        processes=0 if archived else env.CONVERT_PROCESSES,
+        ordered=archived,
+        always_estimate=always_estimate,
+    )
+
+
+def _sync_partition(
+    source: _DB,
+    query_api: influxdb_client.QueryApi,
+    start_time: float,
+    end_time: float | None,
+    dests: list[destinations.Destination],
+    priority: str,
+    sync_plan: planner.Plan,
+):
+    """Sync a single partition of a plan."""
+    gov = governor.for_source(source.name, source.limits)
+
+    with gov.query(priority):
+        if sync_plan.use_processes:
+            query = _build_query(source.bucket, start_time, end_time, source.filter)
+            batches = _read_raw_batches(
+                query_api, query, gov, priority, sync_plan.batch_bytes
+            )
+        else:
+            tables = _query_all(
+                query_api, source.bucket, start_time, end_time, source.filter
+            )
+            batches = _read_batches(tables, gov, priority, sync_plan.batch_bytes)
+
+        return destinations.fan_out(
+            catalog.observe(source.name, latest.observe(source.name, batches)),
+            {
+                dest.name: functools.partial(
+                    destinations.open_writer, dest, source.name
+                )
+                for dest in dests
+            },
+        )
+
+
+def _sync_db(
+    source: _DB,
+    start_time: float,
+    end_time: float | None = None,
+    dests: list[destinations.Destination] | None = None,
+    priority: str = governor.LIVE,
+    tracking: dict[str, str] | None = None,
+):
+    """Pull a target db and back it up to each of its destinations.
+
+    Long ranges are planned first, and may be synced in several partitions,
+    see `planner`.
+
+    Backfills should pass a `priority` of `governor.BACKFILL`, so that they
+    yield to live syncs of the same source.
+
+    If the tracking names of the destinations are given, each destination
+    only receives the partitions ending after its own sync time, and its sync
+    time is advanced to the end of every partition it completes, in order. A
+    destination that falls behind or fails part way through keeps its
+    progress, and a later sync resumes it from there.
+
+    Returns:
+        (dict[str, Exception | None]): For every destination, None if it was
+        fully synced, otherwise the reason it failed.
+    """
+    if dests is None:
+        dests = source.destinations
+
+    client = influxdb_client.InfluxDBClient(
+        url=source.url, token=source.token, org=source.org
+    )
+
+    query_api = client.query_api()
+
+    sync_plan = _plan_db(source, query_api, start_time, end_time, dests)
+    if sync_plan.points is not None:
+        print(f"Plan for '{source.name}': {planner.describe(sync_plan)}")
+
+    synced = {
+        dest.name: db.get_sync_time(tracking[dest.name]) if tracking else start_time
+        for dest in dests
+    }
+    results: dict[str, Exception | None] = {dest.name: None for dest in dests}
+
+    def targets(stop: float | None):
+        # Later partitions are not synced to destinations that failed.
+        return [
+            dest
+            for dest in dests
+            if results[dest.name] is None and (stop is None or synced[dest.name] < stop)
+        ]
+
+    def sync_partition(partition: tuple[float, float | None]):
+        partition_dests = targets(partition[1])
+        if not partition_dests:
+            return {}
+        return _sync_partition(
+            source, query_api, *partition, partition_dests, priority, sync_plan
+        )
+
+    def merge(stop: float | None, partition_results: dict[str, Exception | None]):
+        for name, error in partition_results.items():
+            if results[name] is not None:
+                continue
+            results[name] = error
+            if error is None and tracking and stop is not None:
+                # Partitions are merged in order, so everything before `stop`
+                # has been written to the destination.
+                db.update(tracking[name], stop)
+                synced[name] = stop
+
+    if sync_plan.parallelism == 1:
+        for partition in sync_plan.partitions:
+            if all(error is not None for error in results.values()):
+                break
+            merge(partition[1], sync_partition(partition))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=sync_plan.parallelism
+        ) as executor:
+            for partition, partition_results in zip(
+                sync_plan.partitions,
+                executor.map(sync_partition, sync_plan.partitions),
+            ):
+                merge(partition[1], partition_results)
+
+    return results
+
+
+def load_config(path: str = "sources.yaml", names: list[str] | None = None):
+    """Load and validate the configuration file.
+
+    Args:
+        path (str): The path of the configuration file.
+        names (list[str] | None): If given, only these sources are returned.
+
+    Returns:
+        (tuple[dict[str, YamlType], list[_DB]]): The configuration, and the
+        validated sources.
+    """
+    with open(path, encoding="utf-8") as f:
+        config: dict[str, YamlType] = yaml.safe_load(f.read())
+    dbs = _validate_sources(config)
+
+    if names is not None:
+        unknown = set(names) - {d.name for d in dbs}
+        if unknown:
+            raise RuntimeError(f"Unknown sources: {', '.join(sorted(unknown))}")
+        dbs = [d for d in dbs if d.name in names]
+
+    return config, dbs
+
+
+def verify_all(dbs: list[_DB], window: int, start_time: float, checksum: str):
+    """Verify every source once.
+
+    Returns:
+        (list[str]): The names of the sources that could not be verified.
+    """
+    failed: list[str] = []
+    for d in dbs:
+        for dest in d.destinations:
+            if isinstance(dest, destinations.ArchiveDestination):
+                continue
+            try:
+                print(f"Verifying db '{d.name}' in '{dest.name}'...")
+                divergent = _verify_db(d, dest, start_time, window, checksum)
+                print(f"'{d.name}' verified, {len(divergent)} windows re-synced.")
+            except (IOError, urllib3.exceptions.NewConnectionError) as e:
+                print("FAILED TO VERIFY DB:", d.name, " do to error: ", e)
+                failed.append(d.name)
+
+    return failed
+
+
+def plan_all(dbs: list[_DB]):
+    """Print the plan of the next sync of every source.
+
+    Returns:
+        (list[str]): The names of the sources that could not be planned.
+    """
+    failed: list[str] = []
+    for d in dbs:
+        t = _start_time(_tracking_names(d))
+        client = influxdb_client.InfluxDBClient(url=d.url, token=d.token, org=d.org)
+        try:
+            sync_plan = _plan_db(d, client.query_api(), t, always_estimate=True)
+        except (IOError, urllib3.exceptions.NewConnectionError) as e:
+            print("FAILED TO PLAN DB:", d.name, " do to error: ", e)
+            failed.append(d.name)
+            continue
+        print(f"'{d.name}' from {_format_time(t)}: {planner.describe(sync_plan)}")
+        for start, stop in sync_plan.partitions:
+            end = "now" if stop is None else _format_time(stop)
+            print(f"    {_format_time(start)} - {end}")
+
+    return failed
+
+
+def _copy_errors(copy: _DB, start_time: float):
+    """Copy a bucket between nodes, returning the errors of every failed node."""
+    try:
+        results = _sync_db(copy, start_time, priority=governor.BACKFILL)
+    except (IOError, urllib3.exceptions.NewConnectionError) as e:
+        results = {"": e}
+    return {name: e for name, e in results.items() if e is not None}
+
+
+def rebalance(dbs: list[_DB]):
+    """Move buckets of sharded destinations to the nodes the ring assigns them.
+
+    A moved bucket is copied in full from one of its current nodes to each of
+    its new nodes, then its route is updated, and what was written to the old
+    nodes in the meantime is copied again. The old copies are left in place.
+
+    Returns:
+        (list[str]): The names of the buckets that could not be moved.
+    """
+    import sharding  # pylint: disable=import-outside-toplevel
+
+    failed: list[str] = []
+    for d in dbs:
+        for dest in d.destinations:
+            if not isinstance(dest, destinations.ShardedDestination):
+                continue
+            nodes = {node.name: node for node in dest.nodes}
+            bucket = dest.bucket if dest.bucket is not None else d.name
+
+            for _, old, new in sharding.moves(
+                dest.name, [bucket], list(nodes), dest.replicas
+            ):
+                current = [nodes[name] for name in old if name in nodes]
+                if not current:
+                    print(
+                        f"CANNOT MOVE '{bucket}' in '{dest.name}': none of its "
+                        + f"nodes {old} are configured."
+                    )
+                    failed.append(bucket)
+                    continue
+
+                added = [name for name in new if name not in old]
+                if not added:
+                    db.set_routes(dest.name, bucket, new)
+                    print(f"'{bucket}' in '{dest.name}' now routed to {new}.")
+                    continue
+
+                src = current[0]
+                copy = _DB(
+                    name=d.name,
+                    url=src.url,
+                    token=src.token,
+                    org=src.org,
+                    bucket=bucket,
+                    destinations=[
+                        destinations.InfluxDestination(
+                            name=f"{dest.name}/{name}",
+                            url=nodes[name].url,
+                            token=nodes[name].token,
+                            org=nodes[name].org,
+                            bucket=bucket,
+                        )
+                        for name in added
+                    ],
+                )
+
+                print(f"Moving '{bucket}' in '{dest.name}' from {old} to {new}...")
+                # Syncs keep writing to the old nodes until the route changes,
+                # from the sync time of the destination onwards.
+                since = db.get_sync_time(destinations.tracking_name(d.name, dest))
+                errors = _copy_errors(copy, 0)
+                if errors:
+                    print(f"FAILED TO MOVE '{bucket}' do to errors: ", errors)
+                    failed.append(bucket)
+                    continue
+
+                db.set_routes(dest.name, bucket, new)
+                errors = _copy_errors(copy, since)
+                if errors:
+                    print(
+                        f"FAILED TO CATCH UP '{bucket}' after moving it do to errors: ",
+                        errors,
+                    )
+                    failed.append(bucket)
+                    continue
+
+                stale = sorted(set(old) - set(new))
+                print(
+                    f"'{bucket}' moved. The copies on {stale} are no longer "
+                    + "written to, and are kept."
+                )
+
+    return failed
+
+
+def _backup_of(source: _DB):
+    """Return the central copy of a source, as a source to read it from.
+
+    The copy is read from the first influxdb or sharded destination of the
+    source, without the source's filter, which was applied when it was synced.
+    """
+    for dest in source.destinations:
+        if isinstance(
+            dest, (destinations.InfluxDestination, destinations.ShardedDestination)
+        ):
+            target = destinations.influx_targets(dest, source.name)[0]
+            return _DB(
+                name=source.name,
+                url=target.url,
+                token=target.token,
+                org=target.org,
+                bucket=target.bucket,
+                destinations=[
+                    destinations.InfluxDestination(
+                        name=source.name,
+                        url=source.url,
+                        token=source.token,
+                        org=source.org,
+                        bucket=source.bucket,
+                    )
+                ],
+            )
+
+    raise RuntimeError(f"Source '{source.name}' has no influxdb backup to restore")
+
+
+def _unrestored_spans(name: str, start_time: float, stop_time: float):
+    """Return the parts of a range that have not been restored yet."""
+    spans: list[tuple[float, float]] = []
+    t = start_time
+    for window_start, window_stop in db.get_restored_windows(
+        name, start_time, stop_time
+    ):
+        if window_start > t:
+            spans.append((t, window_start))
+        t = max(t, window_stop)
+    if t < stop_time:
+        spans.append((t, stop_time))
+    return spans
+
+
+def _restore_db(source: _DB, start_time: float, stop_time: float):
+    """Restore a range of a source from its central backup.
+
+    Every unrestored span of the range is planned, see `planner`, and its
+    partitions are copied back in parallel. Each partition is recorded in the
+    tracking database once it is written, so an interrupted restore run again
+    from the same start resumes with the partitions that were not. Restores
+    from another start do not share these records, since the data they
+    restore may have been lost again since. The stop is not part of the key,
+    since it defaults to the current time.
+
+    Returns:
+        (list[Exception]): The reasons any partition failed.
+    """
+    backup = _backup_of(source)
+    name = f"restore/{source.name}/{start_time}"
+
+    client = influxdb_client.InfluxDBClient(
+        url=backup.url, token=backup.token, org=backup.org
+    )
+    query_api = client.query_api()
+
+    def restore_partition(
+        restore_plan: planner.Plan, partition: tuple[float, float | None]
+    ):
+        # Spans have a stop, so every partition planned for one has too.
+        start, stop = partition
+        try:
+            results = _sync_partition(
+                backup,
+                query_api,
+                start,
+                stop,
+                backup.destinations,
+                governor.BACKFILL,
+                restore_plan,
+            )
+        except (IOError, urllib3.exceptions.NewConnectionError) as e:
+            return e
+        error = results[source.name]
+        if error is None and stop is not None:
+            db.add_restored_window(name, start, stop)
+            print(f"    {_format_time(start)} - {_format_time(stop)} restored")
+        return error
+
+    errors: list[Exception] = []
+    for span_start, span_stop in _unrestored_spans(name, start_time, stop_time):
+        restore_plan = _plan_db(
+            backup, query_api, span_start, span_stop, always_estimate=True
+        )
+        print(
+            f"Restoring '{source.name}' {_format_time(span_start)} - "
+            + f"{_format_time(span_stop)}: {planner.describe(restore_plan)}"
+        )
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=restore_plan.parallelism
+        ) as executor:
+            errors.extend(
+                error
+                for error in executor.map(
+                    functools.partial(restore_partition, restore_plan),
+                    restore_plan.partitions,
+                )
+                if error is not None
+            )
+
+    if not errors:
+        db.clear_restored_windows(name)
+    return errors
+
+
+def restore_all(dbs: list[_DB], start_time: float, stop_time: float):
+    """Restore a range of every source from its central backup.
+
+    Data is written back to the source's own bucket. Writes are idempotent, so
+    points the source still has are simply overwritten.
+
+    Returns:
+        (list[str]): The names of the sources that were not fully restored.
+    """
+    failed: list[str] = []
+    for d in dbs:
+        print(f"Restoring db '{d.name}' from its backup...")
+        try:
+            errors = _restore_db(d, start_time, stop_time)
+        except (IOError, urllib3.exceptions.NewConnectionError) as e:
+            errors = [e]
+        if errors:
+            print("FAILED TO RESTORE DB:", d.name, " do to errors: ", errors)
+            print("Run the restore again from the same start to resume it.")
+            failed.append(d.name)
+        else:
+            print(f"'{d.name}' restored.")
+
+    return failed
+
+
+def _tracking_names(source: _DB):
+    """Return the tracking name of every destination of a source."""
+    return {
+        dest.name: destinations.tracking_name(source.name, dest)
+        for dest in source.destinations
+    }
+
+
+def _backfill_new_routes(source: _DB, names: dict[str, str]):
+    """Sync sharded destinations from the start when their bucket is not routed.
+
+    A bucket is routed on its first write, so a destination that just became
+    sharded, or whose nodes were all replaced, gets new nodes that hold none
+    of the data before its sync time.
+    """
+    for dest in source.destinations:
+        if not isinstance(dest, destinations.ShardedDestination):
+            continue
+        import sharding  # pylint: disable=import-outside-toplevel
+
+        bucket = dest.bucket if dest.bucket is not None else source.name
+        if sharding.is_routed(dest.name, bucket, [node.name for node in dest.nodes]):
+            continue
+        if db.get_sync_time(names[dest.name]) > 0:
+            print(f"'{bucket}' is not routed in '{dest.name}', syncing it in full.")
+            db.update(names[dest.name], 0)
+
+
+def _start_time(names: dict[str, str]):
+    # Every destination is written from the oldest sync time of any of them.
+    # Destinations that are ahead receive some points again, which is
+    # harmless since writes are idempotent.
+    return min(db.get_sync_time(name) for name in names.values())
+
+
+def _update_sync_state(
+    source: _DB,
+    names: dict[str, str],
+    sync_time: float,
+    results: dict[str, Exception | None],
+):
+    """Record the sync time of every destination that was fully synced.
+
+    Returns:
+        (bool): True if every destination was fully synced.
+    """
+    print("Updating sync state...")
+    # The catalog describes the source, so it is saved even if some
+    # destinations failed.
+    catalog.CATALOG.flush(source.name)
+    for dest_name, error in results.items():
+        if error is None:
+            db.update(names[dest_name], sync_time)
+        else:
+            print(
+                f"FAILED TO SYNC '{source.name}' TO '{dest_name}' do to error: ",
+                error,
+            )
+    print(f"'{source.name}' finished syncing.")
+    return all(error is None for error in results.values())
+
+
+def _sync_cycle(dbs: list[_DB]):
+    """Sync every source in turn.
+
+    Returns:
+        (list[str]): The names of the sources that were not fully synced.
+    """
+    failed: list[str] = []
+    for d in dbs:
+        source_breaker = breaker.for_source(d.name)
+        if not source_breaker.allow():
+            print(f"Skipping db '{d.name}', source is unreachable.\n")
+            failed.append(d.name)
+            continue
+
+        names = _tracking_names(d)
+        _backfill_new_routes(d, names)
+        t = _start_time(names)
+        sync_time = time.time()
+
+        try:
+            if not breaker.probe(d.url, d.token, d.org):
+                raise IOError(f"'{d.url}' did not answer ping")
+            print(f"Syncing db '{d.name}...'")
+            with memory.trace_peak(d.name):
+                results = _sync_db(d, t, tracking=names)
+            source_breaker.success()
+            if not _update_sync_state(d, names, sync_time, results):
+                failed.append(d.name)
+        except (IOError, urllib3.exceptions.NewConnectionError) as e:
+            source_breaker.failure(e)
+            print("FAILED TO SYNC DB:", d.name, " do to error: ", e)
+            failed.append(d.name)
+
+        print("\n")
+
+    return failed
+
+
+def _sync_cycle_async(dbs: list[_DB]):
+    """Sync every source concurrently in an asyncio event loop.
+
+    Returns:
+        (list[str]): The names of the sources that were not fully synced.
+    """
+    # Imported here since the async client needs the optional aiohttp package.
+    import asyncio  # pylint: disable=import-outside-toplevel
+
+    import aio  # pylint: disable=import-outside-toplevel
+
+    names = {d.name: _tracking_names(d) for d in dbs}
+    jobs: list[aio.Job] = []
+    for d in dbs:
+        _backfill_new_routes(d, names[d.name])
+        t = _start_time(names[d.name])
+
+        # Long ranges are partitioned like in the threaded runtime, so the
+        # partitions of a source run concurrently within its limits.
+        sync_plan: planner.Plan | None = None
+        if breaker.for_source(d.name).allow():
+            client = influxdb_client.InfluxDBClient(url=d.url, token=d.token, org=d.org)
+            try:
+                sync_plan = _plan_db(d, client.query_api(), t)
+            except (IOError, urllib3.exceptions.NewConnectionError) as e:
+                print("FAILED TO PLAN DB:", d.name, " do to error: ", e)
+        if sync_plan is not None and sync_plan.points is not None:
+            print(f"Plan for '{d.name}': {planner.describe(sync_plan)}")
+        partitions = [(t, None)] if sync_plan is None else sync_plan.partitions
+
+        jobs.append(
+            aio.Job(
+                name=d.name,
+                url=d.url,
+                token=d.token,
+                org=d.org,
+                queries=[
+                    _build_query(d.bucket, start, stop, d.filter)
+                    for start, stop in partitions
+                ],
+                dests=d.destinations,
+                limits=d.limits,
+                parallelism=1 if sync_plan is None else sync_plan.parallelism,
+            )
+        )
+    sync_time = time.time()
+
+    print(f"Syncing {len(jobs)} dbs concurrently...")
+    with memory.trace_peak("async cycle"):
+        results = asyncio.run(aio.sync_all(jobs))
+
+    failed: list[str] = []
+    for d in dbs:
+        result = results.get(d.name)
+        if result is None:
+            print(f"Skipped db '{d.name}', source is unreachable.")
+            failed.append(d.name)
+        elif isinstance(result, Exception):
+            print("FAILED TO SYNC DB:", d.name, " do to error: ", result)
+            failed.append(d.name)
+        elif not _update_sync_state(d, names[d.name], sync_time, result):
+            failed.append(d.name)
+
+    return failed
+
+
+def run_cycle(dbs: list[_DB], coordinator: leases.Coordinator, use_async: bool = False):
+    """Sync this worker's share of the sources once.
+
+    Returns:
+        (list[str]): The names of the sources this worker did not fully sync.
+    """
+    owned = set(coordinator.assign([d.name for d in dbs]))
+    if len(owned) < len(dbs):
+        print(
+            f"Syncing {len(owned)} of {len(dbs)} sources, the others are "
+            + "leased by other workers."
+        )
+    dbs = [d for d in dbs if d.name in owned]
+
+    if use_async:
+        failed = _sync_cycle_async(dbs)
+    else:
+        failed = _sync_cycle(dbs)
+
+    print(breaker.report())
+
+    if env.LATEST_SNAPSHOT is not None:
+        latest.CACHE.save(env.LATEST_SNAPSHOT)
+
+    if env.ARCHIVE_COMPACT_DAYS is not None:
+        import archive  # pylint: disable=import-outside-toplevel
+
+        archive_paths = {
+            dest.path
+            for d in dbs
+            for dest in d.destinations
+            if isinstance(dest, destinations.ArchiveDestination)
+        }
+        for path in archive_paths:
+            archive.compact(path, time.time() - env.ARCHIVE_COMPACT_DAYS * 86400)
+
+    return failed
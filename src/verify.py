@@ -0,0 +1,212 @@
+"""Module providing windowed reconciliation of a backup against its source.
+
+Instead of re-pulling data to confirm a backup is complete, cheap aggregate
+queries are run over fixed windows on both the source bucket and the backup
+bucket. Only windows whose aggregates differ need to be re-synced, and windows
+that match are recorded in the tracking database so they are not checked
+again.
+"""
+
+import math
+import time
+from collections.abc import Callable
+
+import influxdb_client
+
+import db
+
+# Maximum number of windows covered by a single aggregate query.
+_MAX_WINDOWS_PER_QUERY = 1000
+
+CHECKSUMS = ("count", "sum")
+
+# Per window aggregates keyed by (window start, "<measurement>:<fn>").
+Aggregates = dict[tuple[float, str], float]
+
+
+def _format_time(t: float):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+
+def _aggregate_query(
+    bucket: str,
+    start_time: float,
+    stop_time: float,
+    window: int,
+    fn: str,
+    source_filter: str = "",
+):
+    """Return a flux query computing per window, per measurement aggregates.
+
+    Fields are aggregated per series first, since values of different fields
+    may have different types and cannot share a table.
+    """
+    if fn == "sum":
+        prelude = 'import "types"\n'
+        select = """
+            |> filter(fn: (r) => types.isType(v: r._value, type: "float")
+                or types.isType(v: r._value, type: "int")
+                or types.isType(v: r._value, type: "uint"))
+            |> toFloat()"""
+    else:
+        prelude = ""
+        select = ""
+
+    time_range = (
+        f"range(start: {_format_time(start_time)}, stop: {_format_time(stop_time)})"
+    )
+    return f"""{prelude}from(bucket: "{bucket}")
+            |> {time_range}{source_filter}{select}
+            |> aggregateWindow(every: {window}s, fn: {fn}, createEmpty: false, timeSrc: "_start")
+            |> toFloat()
+            |> group(columns: ["_measurement", "_time"])
+            |> sum()
+            |> group()"""
+
+
+def _aggregates(
+    query_api: influxdb_client.QueryApi,
+    bucket: str,
+    start_time: float,
+    stop_time: float,
+    window: int,
+    checksum: str,
+    source_filter: str = "",
+):
+    """Return the aggregates of a bucket, keyed by (window start, measurement:fn)."""
+    result: Aggregates = {}
+    for fn in ("count", checksum) if checksum != "count" else ("count",):
+        query = _aggregate_query(
+            bucket, start_time, stop_time, window, fn, source_filter
+        )
+        for record in query_api.query_stream(query):
+            key = (record.get_time().timestamp(), f"{record.get_measurement()}:{fn}")
+            result[key] = float(record.get_value())
+    return result
+
+
+def _differs(a: float | None, b: float | None):
+    if a is None or b is None:
+        return a != b
+    return not math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+
+
+def divergent_windows(source_aggregates: Aggregates, dest_aggregates: Aggregates):
+    """Return the start of every window whose aggregates differ.
+
+    Returns:
+        (set[float]): The start times of the divergent windows.
+    """
+    windows: set[float] = set()
+    for key in source_aggregates.keys() | dest_aggregates.keys():
+        if _differs(source_aggregates.get(key), dest_aggregates.get(key)):
+            windows.add(key[0])
+    return windows
+
+
+def _unverified_spans(
+    db_name: str, start_time: float, stop_time: float, window: int
+):
+    """Yield (start, stop) spans of consecutive windows that are not yet verified."""
+    verified = db.get_verified_windows(db_name, start_time, stop_time)
+
+    span_start: float | None = None
+    span_windows = 0
+    t = start_time
+    while t < stop_time:
+        if (t, t + window) in verified:
+            if span_start is not None:
+                yield span_start, t
+                span_start = None
+        else:
+            if span_start is None:
+                span_start = t
+                span_windows = 0
+            span_windows += 1
+            if span_windows == _MAX_WINDOWS_PER_QUERY:
+                yield span_start, t + window
+                span_start = None
+        t += window
+
+    if span_start is not None:
+        yield span_start, stop_time
+
+
+def verify(
+    db_name: str,
+    source_query_api: influxdb_client.QueryApi,
+    source_bucket: str,
+    dest_query_api: influxdb_client.QueryApi,
+    dest_bucket: str,
+    start_time: float,
+    stop_time: float,
+    window: int = 3600,
+    checksum: str = "count",
+    source_filter: str = "",
+    resync: Callable[[float, float], None] | None = None,
+):
+    """Compare a backup against its source window by window.
+
+    Windows that match are recorded in the tracking database and are skipped
+    by later calls. Windows that differ are passed to `resync`, and are
+    checked again on the next call.
+
+    Args:
+        db_name (str): The name of the tracked database.
+        source_query_api (QueryApi): Query api of the source database.
+        source_bucket (str): The bucket in the source database.
+        dest_query_api (QueryApi): Query api of the backup database.
+        dest_bucket (str): The bucket in the backup database.
+        start_time (float): The start of the range to verify. Rounded down to
+        a multiple of `window`.
+        stop_time (float): The end of the range to verify. Rounded down to a
+        multiple of `window`, so that partially synced windows are skipped.
+        window (int): The window size in seconds.
+        checksum (str): "count" to compare record counts, or "sum" to also
+        compare the sum of all numeric values of each measurement.
+        source_filter (str): Flux `filter()` calls applied to the source, so
+        that data excluded from the backup is not counted.
+        resync (Callable[[float, float], None] | None): Called with the
+        (start, stop) of every divergent window.
+
+    Returns:
+        (list[tuple[float, float]]): The (start, stop) of every divergent window.
+    """
+    if checksum not in CHECKSUMS:
+        raise RuntimeError(f"Unknown checksum '{checksum}'. Expected one of {CHECKSUMS}")
+
+    start_time -= start_time % window
+    stop_time -= stop_time % window
+
+    divergent: list[tuple[float, float]] = []
+    for span_start, span_stop in _unverified_spans(
+        db_name, start_time, stop_time, window
+    ):
+        source_aggregates = _aggregates(
+            source_query_api,
+            source_bucket,
+            span_start,
+            span_stop,
+            window,
+            checksum,
+            source_filter,
+        )
+        dest_aggregates = _aggregates(
+            dest_query_api, dest_bucket, span_start, span_stop, window, checksum
+        )
+        bad = divergent_windows(source_aggregates, dest_aggregates)
+
+        verified: list[tuple[float, float]] = []
+        t = span_start
+        while t < span_stop:
+            if t in bad:
+                divergent.append((t, t + window))
+                if resync is not None:
+                    resync(t, t + window)
+            else:
+                verified.append((t, t + window))
+            t += window
+
+        db.add_verified_windows(db_name, verified)
+
+    return divergent